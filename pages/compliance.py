@@ -73,7 +73,7 @@ with st.expander("**How Compliance Is Assessed**", expanded=False):
     
     **EU Requirements**:
     
-        - NO₂: Daily mean ≤ 25 µg/m³ (2030), max 18 exceedances/year
+        - NO₂: Daily mean ≤ 50 µg/m³ (2030), max 18 exceedances/year
         - PM₁₀: Daily mean ≤ 50 µg/m³ (current) | ≤ 45 µg/m³ (2030), max 35 exceedances/year
         - PM₂.₅: Daily mean ≤ 25 µg/m³ (2030), max 18 exceedances/year
     
@@ -387,8 +387,8 @@ for pollutant in pollutants:
                     with st.expander(f"### {city}", expanded=False):
                         compliant_current = len(city_years[city_years['day_mean_value'] > thresholds.get('daily_current', float('inf'))])
                         compliant_2030 = len(city_years[city_years['day_mean_value'] > thresholds.get('daily_2030', float('inf'))])
-                        exceedances_current = city_years.groupby('year')['day_mean_value'].apply(lambda x: (x > thresholds.get('daily_current', float('inf'))).sum()).reset_index(name='exceedances_current')
-                        exceedances_2030 = city_years.groupby('year')['day_mean_value'].apply(lambda x: (x > thresholds.get('daily_2030', float('inf'))).sum()).reset_index(name='exceedances_2030')
+                        exceedances_current = (city_years['day_mean_value'] > thresholds.get('daily_current', float('inf'))).groupby(city_years['year']).sum().reset_index(name='exceedances_current')
+                        exceedances_2030 = (city_years['day_mean_value'] > thresholds.get('daily_2030', float('inf'))).groupby(city_years['year']).sum().reset_index(name='exceedances_2030')
 
                         col1, col2, col3, col4 = st.columns(4)
                         with col1:
@@ -398,13 +398,13 @@ for pollutant in pollutants:
                                 st.metric("Current Daily Standard", "Not Defined")
                         with col2:
                             if 'daily_current' in thresholds and thresholds['daily_current'] is not None:
-                                 st.metric("**Compliance with current exceedance limit**", f"{len(exceedances_current[exceedances_current['exceedances_current'] <= 35])} of {len(exceedances_current)}", help=f"EU currenlty allows max 35 exceedances/year for daily standard")
+                                 st.metric("**Compliance with current exceedance limit**", f"{len(exceedances_current[exceedances_current['exceedances_current'] <= thresholds['daily_current_allowed']])} of {len(exceedances_current)}", help=f"EU currenlty allows max {thresholds['daily_current_allowed']} exceedances/year for daily standard")
                             else:
                                 st.metric("Compliance with current exceedance limit", "Not Defined")
                         with col3:
                             st.metric("**Days above 2030 target**", f"{compliant_2030} (/{len(city_years)})", help=f"Days where {city} met 2030 daily target of {thresholds.get('daily_2030', 'N/A')} µg/m³")
                         with col4:
-                            st.metric("**Compliance with exceedance limit**", f"{len(exceedances_2030[exceedances_2030['exceedances_2030'] <= 18])} of {len(exceedances_2030)} years", help=f"EU requires max 18 exceedances/year for 2030 daily target")
+                            st.metric("**Compliance with exceedance limit**", f"{len(exceedances_2030[exceedances_2030['exceedances_2030'] <= thresholds['daily_2030_allowed']])} of {len(exceedances_2030)} years", help=f"EU requires max {thresholds['daily_2030_allowed']} exceedances/year for 2030 daily target")
             
     
     # ========================================================================
@@ -487,16 +487,16 @@ for pollutant in pollutants:
                         with st.expander(f"### {city}", expanded=False):
                             compliant_current = len(city_years[city_years['mda8'] > thresholds.get('8h_current', float('inf'))])
                             compliant_2030 = len(city_years[city_years['mda8'] > thresholds.get('8h_2030', float('inf'))])
-                            exceedances_current = city_years.groupby('year')['mda8'].apply(lambda x: (x > thresholds.get('8h_current', float('inf'))).sum()).reset_index(name='exceedances_current')
-                            exceedances_2030 = city_years.groupby('year')['mda8'].apply(lambda x: (x > thresholds.get('8h_2030', float('inf'))).sum()).reset_index(name='exceedances_2030')
+                            exceedances_current = (city_years['mda8'] > thresholds.get('8h_current', float('inf'))).groupby(city_years['year']).sum().reset_index(name='exceedances_current')
+                            exceedances_2030 = (city_years['mda8'] > thresholds.get('8h_2030', float('inf'))).groupby(city_years['year']).sum().reset_index(name='exceedances_2030')
 
                             col1, col2, col3 = st.columns(3)
                             with col1:
                                 st.metric("**Days above standard**", f"{compliant_current} (/{len(city_years)})", help=f"Days where {city} met EU standard of {thresholds.get('8h_current', 'N/A')} µg/m³")
                             with col2:
-                                st.metric("**Compliance with cuurent exceedance limit**", f"{len(exceedances_current[exceedances_current['exceedances_current'] <= 25])} of {len(exceedances_current)} years", help=f"EU requires max 25 exceedances/year for current daily target")
+                                st.metric("**Compliance with cuurent exceedance limit**", f"{len(exceedances_current[exceedances_current['exceedances_current'] <= thresholds['8h_current_allowed']])} of {len(exceedances_current)} years", help=f"EU requires max {thresholds['8h_current_allowed']} exceedances/year for current daily target")
                             with col3:
-                                st.metric("**Compliance with 2030 exceedance limit**", f"{len(exceedances_2030[exceedances_2030['exceedances_2030'] <= 18])} of {len(exceedances_2030)} years", help=f"EU requires max 18 exceedances/year for 2030 daily target")
+                                st.metric("**Compliance with 2030 exceedance limit**", f"{len(exceedances_2030[exceedances_2030['exceedances_2030'] <= thresholds['8h_2030_allowed']])} of {len(exceedances_2030)} years", help=f"EU requires max {thresholds['8h_2030_allowed']} exceedances/year for 2030 daily target")
                 
 
 st.markdown(f"<button style='position: fixed; bottom: 20px; right: 20px; padding: 10px 15px; background-color: #8FDDFA; color: black; border: solid 1px #ccc; border-radius: 10px; cursor: pointer; z-index: 1000;'> <a href='#compliance-intro' class='back-to-top' style='text-decoration: none; color: black;'>Back to top</a></button>", unsafe_allow_html=True)    
@@ -42,13 +42,14 @@ st.markdown("""# Methodology
 ## 4. Data cleaning
 - Timestamp normalization
   - The datetime provided for each measurement is parsed as UTC and converted to datetime format
-  - `local_datetime` is derived using timezone conversion to Europe/Rome
+  - `local_datetime` is the local wall-clock time of the city, converted from UTC with the city timezone (see `config.yml` "timezones"). All the cities sharing a timezone are converted at once, and daily values and MDA8 use the local day of each city
 
-- Basic cleaning rules
-  - drop duplicates
+- Basic cleaning rules (see `config.yml` "cleaning"), all evaluated on the raw rows at once
   - drop rows with missing value or timestamp
   - remove negative values
   - remove extreme values above a hard cap (see `config.yml` "implausible_value_caps")
+  - drop duplicates: among the remaining rows, only the first measurement of each sensor and hour is kept
+  - the rows removed by each rule are counted for each city and parameter
 
 - Feature creation
   From `local_datetime` the pipeline adds some time-related variables: (day, day of the week, season, year)
@@ -70,7 +71,7 @@ st.markdown("""# Methodology
   Such values are in `config.yml` under "sensors_active_per_day_high_flag", "percent_days_avaiable_high_flag", "sensors_active_per_day_medium_flag",  "percent_days_avaiable_medium_flag", "sensors_active_per_day_low_flag" and  "percent_days_avaiable_low_flag"
 
 ## 6. Aggregation strategy
-For each pollutant, after cleaning and quality checks, the pipeline computes several daily and seasonal aggregates, stored as columns in the processed dataframe. The pipeline computes
+For each pollutant, after cleaning and quality checks, the pipeline computes several daily and seasonal aggregates, stored in small summary tables next to the hourly data (one row per sensor-day, city-day, city-season, city-weekday and city-year). The pipeline computes
   - Daily aggregation:
     - `day_mean_value_per_station` → daily mean per station
     - `day_mean_value` → city-day mean (mean across stations’ daily means)
@@ -85,6 +86,7 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
     - For each (city, parameter), the pipeline computes:
       - `rolling_8h_mean` (rolling 8-hour mean on hourly median series)
       - `mda8` (maximum daily 8-hour mean)
+    - For each station, the same is computed on the hourly mean of the station's sensors (`mda8_per_station`), in the same batch as the city series
     - A DST-aware validity rule is applied: a day is valid for MDA8 if at least 75% of the hours in that day have valid rolling values.
 
 ## 7. Indicators and policy metrics
@@ -104,20 +106,25 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
 
 - EU current thresholds (with averaging period definitions)
   - The current thresholds were defined following the indications at https://environment.ec.europa.eu/topics/air/air-quality/eu-air-quality-standards_en (such tresholds were imposed over the course of several years of European legislation). Since daily limits remained almost unchanged (O3 remained unchanged, PM2.5 are unchanged relative to stage 1, while PM10 was 50 µg/m³ for stage 1 and 40 µg/m³ for stage 2, while now the limt is 45 µg/m³) <br>
-  - The relevant values for annual mean limits are stored in `config.yml`:
-  "current_standards_year" refer to the annual mean limit value (PM2.5 = 25, PM10 = 40, NO2 = 40)
+  - They are declared in the `standards` table of `config.yml` (set "current"): annual mean limit values (PM2.5 = 25, PM10 = 40, NO2 = 40), PM10 daily limit of 50 µg/m³ (35 exceedance days per year) and O3 MDA8 target of 120 µg/m³ (25 days per year, averaged over 3 years)
 
 - EU 2030 targets (with definitions)
   - EU 2030 targets were defined following the Directive (EU) 2024/2881 of the European Parliament and of the Council of 23 October 2024 on ambient air quality and cleaner air for Europe (target values are specified in annex I: https://eur-lex.europa.eu/legal-content/EN/TXT/?uri=OJ:L_202402881#anx_I). <br>
-  - They have been sotred in `config.yml` as follows: <br>
-  "new_standards_year" refer to the annual mean limit values indicated (PM2.5 = 10, PM10 = 20, NO2 = 20) <br>
-  "new_standards_day" refer to the maxium daily values (PM2.5 = 25, PM10 = 45, NO2 = 50, O3 = 120) <br>
+  - They are declared in the `standards` table of `config.yml` (set "2030"): annual mean limit values (PM2.5 = 10, PM10 = 20, NO2 = 20) and daily limit values (PM2.5 = 25, PM10 = 45, NO2 = 50, O3 MDA8 = 120), each with 18 exceedance days per year (averaged over 3 years for O3) <br>
+
+- WHO guidelines
+  - WHO 2021 Air Quality Guidelines, declared as the set "who": annual means (PM2.5 = 5, PM10 = 15, NO2 = 10) and 24-hour/8-hour levels (PM2.5 = 15, PM10 = 45, NO2 = 25, O3 MDA8 = 100), with 3 exceedance days per year (the guidelines are 99th percentiles) <br>
+
+- Evaluation
+  - Every standard is applied to every city and year in one pass: annual standards compare the yearly mean of their daily metric with the limit, daily and 8h standards compare the days above the limit (averaged over the declared years, when all of them are available) with the allowed exceedances. Adding a set of standards only takes new rows in `config.yml`; the dashboard reads its thresholds from the same table <br>
+  - The compliance table counts the days above the 2030 daily limit and compares them with the exceedances allowed now and from 2030 <br>
 
 
 ## 9. CAQI
 - Mapping from pollutant metrics to CAQI categories
    - CAQI breakpoint were taken from this study: https://web.archive.org/web/20160222064802/http://www.airqualitynow.eu/download/CITEAIR-Comparing_Urban_Air_Quality_across_Borders.pdf
    Coherently with the study, the daily max value was used for NO2 and O3, while the daily mean value for PM10 and PM2.5
+   Each city-day and parameter gets the category (Good, Fair, Moderate, Poor, Very Poor, Extremely Poor) of the first breakpoint its value does not exceed (values above the last breakpoint are Extremely Poor, negative or missing values get no category); the global CAQI of a city-day is the worst category across parameters
 - Assumptions and caveats
   - Naturally, data are completely insufficient for a robust assessment of general air quality. In the supplementary reports the CAQI was nonetheless included as an exploration for comparing general air quality (across parameters) between cities.
 
@@ -142,13 +149,27 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
     - **Raw Data** --> Collections of raw measurements data ->  `data/raw/raw_data.csv`
     - **Failed** --> Collection of pages for which Errors happened and measurements were not collected -> `data/raw/failed.csv`
     - **Sensors** --> Dataset of sensors found by the OpenAQ API -> `data/raw/sensors.csv`
+    - **Raw Partitions** --> Raw measurements split by city, parameter and year (chunked mode only) -> `data/raw/partitioned/`
 
   - data/processed/
-    - **Clean Data** --> Dataset of hourly measurements after the cleaning process -> `data/processed/clean.csv`
-    - **Daily Data** --> Dataset for daily aggregates after cleaning -> `data/processed/daily_data.csv`
+    - Processed tables are Parquet datasets (zstd, dictionary-encoded strings) partitioned by `city=`/`parameter=`/`year=` folders
+    - **Clean Data** --> Dataset of hourly measurements after the cleaning process (with hourly median and rolling 8h mean) -> `data/processed/clean/`
+    - **Sensor Day** --> Daily coverage for each sensor, with the daily mean, max, median and MDA8 of its station -> `data/processed/sensor_day/`
+    - **Sensor Day State** --> Mergeable state of the hourly values of each sensor-day (sum, count, max, bitmask of the measured hours and a sketch of the values for medians). States of chunks, workers or runs can be combined into any coarser group (station-day, city-day...) without the hourly rows; the station daily means and max are computed this way, merging the states without their sketches (the published medians are computed exactly from the hourly rows; the sketches are kept for combining the stored states later) -> `data/processed/sensor_day_state/`
+    - **Sensor Tensor** (optional, `pipeline.tensor`) --> Dense float32 array of the clean hourly values, one row per sensor and one column per UTC hour of the analysis period (NaN where not measured), with the city, parameter, station and sensor of each row. Saved as a `.npy` file so it can be memory-mapped (`Load_Tensor`) for vectorized time-series work. Export only: no stage of the pipeline reads it -> `data/processed/tensor/`
+    - **Sensor Year** --> Yearly coverage, validity and longest gap within a day for each sensor (before excluding invalid sensors) -> `data/processed/sensor_year/`
+    - **Sensor Coverage** --> Coverage index with one bitmask for each sensor and local day (bit h set when the sensor measured h hours after local midnight), the length of the day and whether the sensor-day survived the quality checks. Daily and yearly coverage, active sensors and gaps are computed from it -> `data/processed/sensor_coverage/`
+    - **City Day** --> Daily mean, max, median, MDA8 and active sensors for each city and parameter -> `data/processed/city_day/`
+    - **City Weekday / Season / Year** --> Mean values per week day, season and year (with quality flags) for each city and parameter -> `data/processed/city_weekday/`, `data/processed/city_season/`, `data/processed/city_year/`
+    - **Station Descriptive** --> Descriptive statistics of the cleaned measurements for each station and year -> `data/processed/station_descriptive/`
+    - **Manifest** --> Fingerprint of each (city, parameter, year) partition used by the incremental runs -> `data/processed/manifest.json`
+    - **Stage Manifest** --> Key of the last run of each pipeline stage -> `data/processed/stages.json`
+    - **Daily Data** --> Dataset for daily aggregates after cleaning, one row per city, parameter and day -> `data/processed/daily_data.parquet`
+    - **Daily CAQI** --> CAQI category of each city, parameter and day, with the global CAQI of the city-day -> `data/processed/caqi_daily.parquet`
 
   - data/descriptive/
     - **Pre Cleaning Descriptive** --> Descriptive statistics of raw measurements data for each sensor -> `data/descriptive/pre_cleaning_descriptive.csv`
+    - **Cleaning Rejections** --> Rows removed by each cleaning rule (and rows kept) for each city and parameter -> `data/descriptive/cleaning_rejections.csv`
     - **Processed Descriptive** --> Descriptive statistics of measurements data after cleaning for each sensor -> `data/descriptive/pre_cleaning_descriptive.csv`
     - **Sensors Metadata** --> Polished dataset with used sensors metadata -> `data/descriptive/sensors_metadata.csv`
 
@@ -159,18 +180,19 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
   - results/quality_checks/deepdive
     - **Torino Aggregation** --> Dataframe confronting different aggregation methods for calculating annual aggregates for the city of Turin -> `results/quality_chekcs/deepdive/Torino_aggregation.csv`
     - **Torino Annual Mean Per Sensor** --> Dataframe containing annual mean aggregates for each sensor in Turin -> `results/quality_chekcs/deepdive/Torino_annual_mean_per_station_descriptive.csv`
-    - **Torino Exceedance Days Per Sensor** --> Dataframe calculating exceedance days for each sensor in Turin -> `results/quality_chekcs/deepdive/Torino_exceedance_days_per_station_descriptive.csv`
+    - **Torino Exceedance Days Per Sensor** --> Dataframe calculating exceedance days for each sensor in Turin (daily mean of the station, or its MDA8 for O3; a station-day counts once, with the yearly coverage of its sensor with the lowest id) -> `results/quality_chekcs/deepdive/Torino_exceedance_days_per_station_descriptive.csv`
 
   - results/
     - **Compliance table** --> Table which compare annual averages and exeedance days with EU cuurent standards and 2030 targets -> `results/compliance_table.csv`
+    - **Standards compliance** --> Value (annual mean or exceedance days) and compliance of every city and year with every declared standard -> `results/standards_compliance.csv`
 
 - Produced figures:
   - results/
     - plots/
       - CAQI/
         - CAQI_per_parameter/ 
-          - `CAQI_*.png` --> Collection of daily CAQI plots for each parameter separately
-        - `CAQI_global.png` --> Daily global CAQI for each city
+          - `CAQI_*.png` --> Calendar of the daily CAQI category of each parameter (a row per year and a column per calendar day, 29 February included, for each city)
+        - `CAQI_global.png` --> Calendar of the daily global CAQI category for each city
         - `count_CAQI.png` --> Count plot for each CAQI category per city
       - density_plots/ 
         - `daily_averages_densityplot_*.png` --> Collection of desity plots for each city, divided per parameter
@@ -197,12 +219,25 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
     - retry_failed -> select if retry for failed pages
     - do_fetch -> select if fetch data
     - do_clean -> select if doing cleaning and aggregation
-    - do_results -> select if producing results
+    - do_results -> select if producing results. When it runs right after a single-process cleaning, the daily and yearly tables are handed over in memory instead of being read back from `data/processed`
+    - incremental -> recompute only the (city, parameter, year) partitions whose cleaned input changed since the last run (plus the following year, whose first day depends on the rolling 8h means). Falls back to a full run when there is no manifest or when `implausible_value_caps`, `cleaning`, `flags` (apart from the thresholds of the city flags, set after the cleaning) or the timezones changed
+    - chunked -> process the raw data one (city, parameter, year) partition at a time instead of loading it all at once, so that memory is bounded by the largest partition. Each partition keeps the last day of the previous year as context for the rolling 8h means; city-level tables are then built from the stored per-partition tables. Rows without a date belong to no partition: they are kept in `data/raw/undated/` and only counted by the cleaning rules, as in a full run
+    - chunk_rows -> number of raw csv rows read at a time when splitting the raw data into partitions (chunked mode only)
+    - workers -> number of processes. Above 1 the cleaning steps after `Clean` run one city per process (the rows of each city are handed over as Parquet files in `data/tmp/cities/`, and each process saves its tables to `data/processed`, where the next stages read them), and every figure is rendered as its own job with only the data it draws; the outputs are the same as with a single process. The time taken by each figure is printed at the end of the results
+    - tensor -> also save the Sensor Tensor after the cleaning
+    - plot_cache -> skip the figures whose inputs did not change since their last render. Each figure is keyed by a hash of the data it draws, its arguments, the code of its figure function, the settings it reads and the seaborn/matplotlib versions; the keys of the last renders are kept in `results/plots_manifest.json`. Set to false to render every figure again
+    - stage_cache -> skip the pipeline stages whose inputs did not change since their last run. Each stage is keyed by a hash of the keys of its input stages (or the size and modification time of the raw files), the settings it reads and its code; a stage also runs again when one of its outputs is missing or one of its inputs ran. The keys are kept in `data/processed/stages.json`. Set to false to run every stage again
+
+  - aggregates -> mergeable daily states
+    - sketch_size -> number of values kept by the sketch of each state. Medians are exact up to this many values, approximated by evenly weighted quantiles above it
 
   - locations -> list of cities to be queried
 
   - parameters -> list of paramteres
 
+  - default_timezone -> timezone used for the cities without one
+  - timezones -> timezone of each city. Cities not listed take the most common timezone of their stations in `data/raw/sensors.csv`, or `default_timezone`
+
   - yearfrom -> from which year retrieve measurements
   - yearto -> until which year retrieve measurements
 
@@ -214,6 +249,10 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
 
   - implausible_value_caps -> values from which the collected measurements is considered invalid
 
+  - cleaning -> cleaning rules applied to the raw measurements
+    - duplicate_key -> columns identifying the same measurement
+    - rules -> one entry for each rule, named as in the rejection counts, with the `column` it checks and its `check`: `missing` (empty values), `below` or `above` a `limit` (a number, or one limit for each parameter such as the implausible value caps), or `flatline` (runs of at least `hours` consecutive hourly measurements of a sensor with the same value, duplicated rows counted once)
+
   - flags -> parameters for quality filtering
     - sensors_active_per_day_high_flag -> number of median active sensors per day for the high quality flag
     - percent_days_avaiable_high_flag -> percent of days avaiable in a year for the high quality flags
@@ -225,11 +264,7 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
     - percent_coverage_valid_day -> percent of hours avaiable in a day to be valid
     - exclude_invalid_days -> selects whether to exclude invalid days
 
-  - new_standards_year -> EU 2030 targets for annual means
-
-  - current_standards_year -> EU current standards for annual means
-
-  - new_standards_day -> EU 2030 targets for daily maximums
+  - standards -> one row per standard: set (current, 2030, who), parameter, period (annual, daily or 8h), metric (daily column it is assessed on), limit (µg/m³), allowed (exceedance days per year, default 0) and years (years the exceedance days are averaged over, default 1)
 
   - CAQI_breakpoints -> CAQI breakpoints for each parameter
 
@@ -244,6 +279,21 @@ For each pollutant, after cleaning and quality checks, the pipeline computes sev
   2. `clean_data()` → `data/processed/` + `data/quality_checks/`
   3. `get_results()` → `results/`
 
+  The last two run these stages in order, each one only when needed (see `stage_cache`):
+  - clean -> raw files, cleaning settings -> processed tables
+  - calendar_means -> clean -> week day and season tables
+  - tensor (when `pipeline.tensor`) -> clean, analysis period -> Sensor Tensor
+  - flags -> clean, city flag thresholds -> quality flags of `city_year`
+  - quality_reports -> clean, flags -> quality csv and heatmaps
+  - daily_data -> clean, calendar_means, flags -> Daily Data
+  - caqi -> clean, `CAQI_breakpoints` -> Daily CAQI
+  - standards -> clean, `standards` -> `results/standards_compliance.csv`
+  - compliance_table -> daily_data, standards, flags -> `results/compliance_table.csv`
+  - caqi_plots -> caqi -> `results/plots/CAQI/`
+  - main_plots -> daily_data -> main, density and seasonal figures
+  - deepdive_plots -> clean, `quality_deep_locations` -> deep dive figures
+  - deep_dive_tables -> clean, flags, `quality_deep_locations` -> deep dive tables
+
   Run via `pipeline.py` (see README for details).
 
 ## 12. Limitations and ethical notes
@@ -17,37 +17,42 @@ import plotly.express as px
 with open("config.yml", "r", encoding="utf-8") as f:
     config = yaml.safe_load(f)
 
-# EU Standards
-st.session_state.EU_STANDARDS = {
-    "no2 µg/m³": {
-        "annual_current": 40,
-        "annual_2030": 20,
-        "daily_current": None,
-        "daily_2030": 25
-    },
-    "o3 µg/m³": {
-        "8h_current": 120,
-        "8h_2030": 120
-    },
-    "pm10 µg/m³": {
-        "annual_current": 40,
-        "annual_2030": 20,
-        "daily_current": 50,
-        "daily_2030": 45
-    },
-    "pm25 µg/m³": {
-        "annual_current": 25,
-        "annual_2030": 10,
-        "daily_current": None,
-        "daily_2030": 25
-    }
-}
+# Standards (EU current, EU 2030 and WHO), declared once in config.yml
+# e.g. EU_STANDARDS["pm10 µg/m³"] = {"annual_current": 40, "daily_current": 50, "daily_current_allowed": 35, "annual_2030": 20, "daily_2030": 45, ...}
+st.session_state.EU_STANDARDS = {}
+for standard in config['standards']:
+    thresholds = st.session_state.EU_STANDARDS.setdefault(standard['parameter'], {})
+    thresholds[f"{standard['period']}_{standard['set']}"] = standard['limit']
+    if 'allowed' in standard:
+        thresholds[f"{standard['period']}_{standard['set']}_allowed"] = standard['allowed']   # Exceedance days allowed per year
+
+def read_processed(table, columns):
+    """Read one of the processed Parquet tables for the analysed cities and years."""
+    table = pd.read_parquet(
+        f"data/processed/{table}",
+        columns=columns,
+        filters=[
+            ('city', 'in', config['locations']),
+            ('year', '>=', config['yearfrom']),
+            ('year', '<=', config['yearto'])
+        ]
+    )
+    table['city'] = table['city'].astype(str)
+    table['parameter'] = table['parameter'].astype(str)
+    table['year'] = table['year'].astype(int)
+    return table
 
 @st.cache_data
 def load_data():
     """Load processed data and quality checks."""
     try:
-        clean = pd.read_parquet("data/clean.parquet")
+        stations = read_processed("sensor_day", ['city', 'parameter', 'year', 'day', 'station_name', 'n_hours',
+                                                 'day_mean_value_per_station', 'day_max_value_per_station', 'day_median_value_per_station'])
+        days = read_processed("city_day", ['city', 'parameter', 'year', 'day', 'season', 'day_mean_value', 'day_max_value', 'day_median_value', 'mda8'])
+        flags = read_processed("city_year", ['city', 'parameter', 'year', 'flag_city_parameter'])
+        clean = (stations
+                 .merge(days, on=['city', 'parameter', 'year', 'day'], how='left')
+                 .merge(flags, on=['city', 'parameter', 'year'], how='left'))
         quality_city = pd.read_csv("results/quality_checks/cities_quality.csv")
         
         try:
@@ -126,7 +131,7 @@ with col3:
     """, unsafe_allow_html=True)
 
 with col4:
-    total_measurements = len(clean_df)
+    total_measurements = clean_df['n_hours'].sum()
     st.markdown(f"""
     <div class="metric-card" style="height: 200px;">
         <div style="font-size: 0.875rem; opacity: 0.9;">Measurements</div>
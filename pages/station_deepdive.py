@@ -1,6 +1,7 @@
 import streamlit as st
 import plotly.express as px
 import pandas as pd
+import numpy as np
 
 sensors_metadata = pd.read_csv("data/descriptive/sensors_metadata.csv")
 
@@ -61,7 +62,14 @@ else:
         st.plotly_chart(sensors_map, width='stretch')
 
         st.subheader("Sensors Coverage Analysis")
-        sensor_coverage = dd_df.groupby(['day', 'station_name'])['value'].count().reset_index(name='count')
+        coverage = pd.read_parquet(
+            "data/processed/sensor_coverage",
+            columns=['day', 'station_name', 'hours_mask', 'included'],
+            filters=[('city', '=', city_dd), ('parameter', '=', pollutant_dd), ('year', '>=', years[0]), ('year', '<=', years[1])]
+        )
+        coverage = coverage[coverage['included']]                       # Sensor-days kept after the quality checks
+        station_masks = coverage.groupby(['day', 'station_name'])['hours_mask'].agg(np.bitwise_or.reduce)
+        sensor_coverage = pd.Series(np.bitwise_count(station_masks.to_numpy()), index=station_masks.index).reset_index(name='count')   # Hours measured by at least one sensor of the station
         fig_cov = px.ecdf(
             sensor_coverage,
             x='count',
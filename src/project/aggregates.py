@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import yaml
+
+with open("config.yml", "r", encoding="utf-8") as f:
+    config = yaml.safe_load(f)
+
+STATE_COLUMNS = ['value_sum', 'value_count', 'value_max', 'hours_mask', 'sketch_values', 'sketch_weights']   # Mergeable state of a group of hourly values
+
+def sketch_arrays(codes, values, weights, n_groups, size=config["aggregates"]["sketch_size"]):
+    # Sorted (value, weight) items of each group, groups with more than `size` items thinned to `size` evenly weighted quantiles
+    order = np.argsort(values, kind="stable")
+    order = order[np.argsort(codes[order], kind="stable")]                         # By group, then by value
+    codes, values, weights = codes[order], values[order], weights[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    big = counts > size
+    if big.any():
+        cumulative = np.cumsum(weights)
+        ends = np.cumsum(counts)
+        before = np.where(ends - counts > 0, cumulative[np.maximum(ends - counts - 1, 0)], 0)   # Weight of the items of the previous groups
+        totals = cumulative[np.maximum(ends - 1, 0)] - before
+        groups = np.flatnonzero(big)
+        targets = np.repeat(before[groups], size) + (np.tile(np.arange(size), len(groups)) + 0.5) * np.repeat(totals[groups] / size, size)
+        picked = np.searchsorted(cumulative, targets)                              # Item at each quantile of the big groups
+        keep = ~big[codes]
+        codes = np.concatenate([codes[keep], np.repeat(groups, size)])
+        values = np.concatenate([values[keep], values[picked]])
+        weights = np.concatenate([weights[keep], np.repeat(totals[groups] / size, size)])
+        order = np.lexsort((values, codes))
+        codes, values, weights = codes[order], values[order], weights[order]
+        counts = np.bincount(codes, minlength=n_groups)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return offsets, values, weights
+
+def sketch_column(offsets, items):
+    lists = pa.ListArray.from_arrays(pa.array(offsets, pa.int64()), pa.array(items, pa.float64()))
+    return pd.Series(lists.to_numpy(zero_copy_only=False), dtype=object)          # One array for each state (list column in Parquet)
+
+def sketch_items(column):
+    # Flat items and state of each item of a sketch column
+    lists = pa.array(column.to_numpy(), type=pa.list_(pa.float64()))
+    return np.repeat(np.arange(len(lists)), lists.value_lengths().to_numpy()), lists.flatten().to_numpy()
+
+def Day_States(clean_data, keys, hours):
+    # One state for each group of keys (as sensor-day or city-day) from the hourly rows and their hours since local midnight
+    groups = clean_data.groupby(keys, sort=True)
+    codes = groups.ngroup().to_numpy()
+    values = clean_data['value'].to_numpy(dtype=float)
+    states = groups['value'].agg(value_sum='sum', value_count='count', value_max='max').reset_index()
+    masks = np.zeros(len(states), dtype=np.uint32)
+    np.bitwise_or.at(masks, codes, (1 << hours).astype(np.uint32))                 # Bit h set when measured h hours after local midnight
+    states['hours_mask'] = masks
+    offsets, items, weights = sketch_arrays(codes, values, np.ones(len(values)), len(states))
+    states['sketch_values'] = sketch_column(offsets, items)
+    states['sketch_weights'] = sketch_column(offsets, weights)
+    return states
+
+def Merge_States(states, keys, sketch=True):
+    # Combining partial states (from chunks, workers, runs or finer keys) into one state for each group of keys (without the sketches when no median is needed)
+    states = pd.concat(states, ignore_index=True) if isinstance(states, list) else states
+    groups = states.groupby(keys, sort=True)
+    codes = groups.ngroup().to_numpy()
+    merged = groups.agg(value_sum=('value_sum', 'sum'), value_count=('value_count', 'sum'), value_max=('value_max', 'max')).reset_index()
+    masks = np.zeros(len(merged), dtype=np.uint32)
+    np.bitwise_or.at(masks, codes, states['hours_mask'].to_numpy(dtype=np.uint32))
+    merged['hours_mask'] = masks
+    if not sketch:
+        return merged
+    rows, items = sketch_items(states['sketch_values'])
+    _, weights = sketch_items(states['sketch_weights'])
+    offsets, items, weights = sketch_arrays(codes[rows], items, weights, len(merged))
+    merged['sketch_values'] = sketch_column(offsets, items)
+    merged['sketch_weights'] = sketch_column(offsets, weights)
+    return merged
+
+def sketch_median(states):
+    # Weighted median of each sketch (the exact median while the group has no more items than the sketch size)
+    rows, items = sketch_items(states['sketch_values'])
+    _, weights = sketch_items(states['sketch_weights'])
+    medians = np.full(len(states), np.nan)
+    if len(items) == 0:
+        return medians
+    cumulative = np.cumsum(weights)
+    counts = np.bincount(rows, minlength=len(states))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    has = counts > 0
+    before = np.where(starts > 0, cumulative[np.maximum(starts - 1, 0)], 0)
+    half = before + (cumulative[np.maximum(ends - 1, 0)] - before) / 2
+    low = np.minimum(np.searchsorted(cumulative, half[has]), ends[has] - 1)   # First item reaching half of the weight
+    high = np.where(cumulative[low] == half[has], np.minimum(low + 1, ends[has] - 1), low)   # And the next one when exactly at half
+    medians[has] = (items[low] + items[high]) / 2
+    return medians
+
+def Finalize_States(states, median=True):
+    # Statistics of each state (the median only when asked, from the sketches)
+    stats = states.drop(columns=STATE_COLUMNS, errors='ignore').assign(
+        mean_value=states['value_sum'] / states['value_count'],
+        max_value=states['value_max'])
+    if median:
+        stats['median_value'] = sketch_median(states)
+    return stats.assign(
+        n_hours=states['value_count'],
+        measured_hours=np.bitwise_count(states['hours_mask'].to_numpy(dtype=np.uint32)))
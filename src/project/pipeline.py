@@ -1,13 +1,27 @@
+import numpy as np
+import functools
+import hashlib
+import inspect
+import json
+import operator
 import pandas as pd
+import shutil
 import yaml
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
 from .fetch import Coordinates, Get_Sensors, Get_Data, Save_Raw, Retry_Failed, Close_OpenAQ_Client
-from .processing import Clean, Time_Aggregation, Quality_Checks, Quality_Plots_heatmaps, Calculate_Average_Values, Save_Clean
-from .results import Cutting_Hourly_Values, Make_Compliance_Table, Make_Plots, Quality_Plots_deepdive, Deep_Dive_table
+from .processing import Clean, Time_Aggregation, Quality_Checks, Quality_Reports, Quality_Plots_heatmaps, Calculate_Average_Values, Calendar_Means, Save_Clean, Fingerprint_Partitions, Dirty_Partitions, Select_Partitions, Save_Manifest, Partition_Raw, Load_Raw_Partition, Load_Raw_Undated, Load_Manifest, Drop_Partitions, Save_Rejections, Save_Tensor, Load_Clean, Flag_Cities, PROCESSING_CONFIG_KEYS, CITY_FLAG_KEYS
+from .standards import Evaluate_Standards, Load_Standards_Evaluation
+from .results import Daily_Values, Cutting_Hourly_Values, Load_Daily_Data, CAQI_Table, Load_CAQI, Make_Compliance_Table, Plot_Jobs, CAQI_Plot_Jobs, Deepdive_Plot_Jobs, Stale_Plots, Save_Plot_Manifest, Report_Timings, Deep_Dive_table
 
 with open("config.yml", "r", encoding="utf-8") as f:
     config = yaml.safe_load(f)
 
 locations = config["locations"]
+SHARED_TABLES = ['station_descriptive', 'sensor_year', 'sensor_day', 'city_day', 'city_year', 'city_weekday', 'city_season']   # Compact tables read again by the later stages (the hourly rows stay on disk)
+FILTERS = {'=': operator.eq, '==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+           'in': lambda column, values: column.isin(values), 'not in': lambda column, values: ~column.isin(values)}   # Parquet filters on a table in memory
 
 def fetch_data(retry_failed = config["pipeline"]["retry_failed"]):
     print(f"Fetching data for {locations} begin")
@@ -26,31 +40,288 @@ def fetch_data(retry_failed = config["pipeline"]["retry_failed"]):
     Close_OpenAQ_Client()
     
 
-def clean_data():
+class Dataset:
+    # Tables of the Parquet store shared by the stages of a run: the ones made in this run are handed over in memory, the others read once
+    def __init__(self):
+        self.tables = {}
+        self.outputs = {}                                       # Results of the stages run (daily table, CAQI, standards)
+
+    def keep(self, tables):
+        for name, table in tables.items():
+            if name in SHARED_TABLES:
+                partition_cols = [c for c in ['city', 'parameter', 'year'] if c in table.columns]
+                table = table[[c for c in table.columns if c not in partition_cols] + partition_cols].astype({c: int if c == 'year' else str for c in partition_cols})
+                self.tables[name] = table.sort_values(partition_cols, kind="stable", ignore_index=True)   # Columns and rows as read back from the store
+
+    def load(self, name, columns=None, filters=None):
+        # Same as Load_Clean
+        if name not in SHARED_TABLES:
+            return Load_Clean(name, columns, filters)
+        if name not in self.tables:
+            self.tables[name] = Load_Clean(name)
+        table = self.tables[name]
+        rows = np.ones(len(table), dtype=bool)
+        for column, op, value in filters or []:
+            rows &= FILTERS[op](table[column], value).to_numpy()
+        return table.loc[rows, columns if columns is not None else list(table.columns)].reset_index(drop=True)
+
+    def output(self, name, reader):
+        # Result of a stage of this run, or read back from its file
+        return self.outputs[name] if name in self.outputs else reader()
+
+
+def Run_Tasks(tasks, workers=config["pipeline"]["workers"]):
+    # Running (function, *args) tasks in a process pool, or one after the other with a single worker
+    if workers <= 1:
+        return [task[0](*task[1:]) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(*task) for task in tasks]
+        return [future.result() for future in futures]             # Re-raising the first error of the workers
+
+def Split_Cities(clean_data):
+    # One Parquet file with the rows of each city, read back by the workers
+    folder = Path("data/tmp/cities")
+    shutil.rmtree(folder, ignore_errors=True)
+    folder.mkdir(parents=True)
+    paths = {}
+    for city, rows in clean_data.groupby('city', sort=False):
+        paths[city] = folder / f"{quote(city, safe='')}.parquet"
+        rows.to_parquet(paths[city], engine="pyarrow", index=False)
+    return paths
+
+def clean_city(rows, partitions=None):
+    # Steps after Clean, on a dataframe or on the Parquet file of one city
+    if isinstance(rows, Path):
+        rows = pd.read_parquet(rows, engine="pyarrow")
+    df = Time_Aggregation(rows)
+    df, quality_tables = Quality_Checks(df)
+    tables = {**quality_tables, **Calculate_Average_Values(df)}
+    Save_Clean(tables, partitions)
+    return {name: table for name, table in tables.items() if name in SHARED_TABLES}   # Handed over to the next stages
+
+def clean_city_saved(path, partitions):
+    # Pool task: the tables of the city are saved as Parquet partitions and only their names go back (no dataframe pickled to the parent)
+    return sorted(clean_city(path, partitions))
+
+def clean_tables(incremental=config["pipeline"]["incremental"], chunked=config["pipeline"]["chunked"], workers=config["pipeline"]["workers"], dataset=None):
+    dataset = Dataset() if dataset is None else dataset
+    if chunked:
+        return clean_tables_chunked(incremental, workers, dataset)
+
     print("Start cleaning...")
-    df = Clean()
-    df = Time_Aggregation(df)
-    df = Quality_Checks(df)
-    Quality_Plots_heatmaps()
-    df = Calculate_Average_Values(df)
-    Save_Clean(df)
-
-def get_results():
+    df, rejections = Clean()
+    Save_Rejections([rejections])
+    fingerprints = Fingerprint_Partitions(df)
+    partitions = Dirty_Partitions(fingerprints) if incremental else None
+    if partitions is not None:
+        if not partitions:
+            print("Raw data unchanged, nothing to recompute")
+            return
+        df = Select_Partitions(df, partitions)                  # Only the changed (city, parameter, year) and their context
+    if workers > 1:
+        Drop_Partitions(partitions)                             # Each city then saves its own partitions
+        to_save = partitions if partitions is not None else {(city, parameter, int(year)) for city, parameter, year in (key.split("|") for key in fingerprints)}
+        paths = Split_Cities(df)
+        del df
+        Run_Tasks([(clean_city_saved, path, {p for p in to_save if p[0] == city}) for city, path in paths.items()], workers)   # The next stages read the tables back from the store
+        shutil.rmtree("data/tmp/cities", ignore_errors=True)
+    else:
+        tables = clean_city(df, partitions)
+        if partitions is None:
+            dataset.keep(tables)                                # Whole tables only (a partial update is read back from the store)
+    Save_Manifest(fingerprints)
+
+def clean_city_chunked(partitions, previous):
+    # Partitions of one city, one after the other (the last day of each year is the context of the next one)
+    fingerprints = {}
+    rejections = []
+    carry = None
+    for n, (city, parameter, year) in enumerate(partitions):
+        print(f"Chunk {n + 1}/{len(partitions)}: {city}, {parameter}, {year}")
+        if n == 0 or partitions[n - 1][:2] != (city, parameter):
+            carry, dirty_before = None, False                   # New series
+        df, partition_rejections = Clean(Load_Raw_Partition(city, parameter, year))
+        rejections.append(partition_rejections)
+        fingerprints.update(Fingerprint_Partitions(df))
+        key = f"{city}|{parameter}|{year}"
+        dirty = previous is None or previous.get(key) != fingerprints.get(key)
+        if not (dirty or dirty_before):
+            print("Unchanged")
+        df = Time_Aggregation(df)
+        df, quality_tables = Quality_Checks(df)
+        if dirty or dirty_before:                               # Changed, or the previous year feeding its rolling means changed
+            tables = Calculate_Average_Values(pd.concat([carry, df], ignore_index=True)) if not df.empty else {}
+            Save_Clean({**quality_tables, **tables}, {(city, parameter, year)})
+        carry = df[df['day'] == df['day'].max()]                # Last day as context for next year's rolling means
+        dirty_before = dirty
+    path = Path("data/tmp/rejections") / f"{quote(partitions[0][0], safe='')}.parquet"
+    pd.concat(rejections, ignore_index=True).to_parquet(path, engine="pyarrow", index=False)   # Read back by the parent instead of pickled
+    return fingerprints, path
+
+def clean_tables_chunked(incremental=config["pipeline"]["incremental"], workers=config["pipeline"]["workers"], dataset=None):
+    dataset = Dataset() if dataset is None else dataset
+    print("Start cleaning (chunked)...")
+    partitions = Partition_Raw()
+    previous = Load_Manifest() if incremental else None
+    if previous is None:
+        Drop_Partitions()                                       # Full rebuild
+
+    cities = {}
+    for partition in partitions:
+        cities.setdefault(partition[0], []).append(partition)   # Raw partitions already sorted by city, parameter and year
+    fingerprints = {}
+    rejections = []
+    shutil.rmtree("data/tmp/rejections", ignore_errors=True)
+    Path("data/tmp/rejections").mkdir(parents=True)
+    for city_fingerprints, path in Run_Tasks([(clean_city_chunked, city_partitions, previous) for city_partitions in cities.values()], workers):
+        fingerprints.update(city_fingerprints)
+        rejections.append(pd.read_parquet(path, engine="pyarrow"))
+    shutil.rmtree("data/tmp/rejections", ignore_errors=True)
+    undated = Load_Raw_Undated()
+    if not undated.empty:
+        rejections.append(Clean(undated)[1])                    # Rows without a date, in no partition
+    Save_Rejections(rejections)
+
+    if previous is not None:
+        removed = {tuple(key.split("|")) for key in set(previous) - set(fingerprints)}
+        Drop_Partitions({(city, parameter, int(year)) for city, parameter, year in removed})
+    Save_Manifest(fingerprints)
+
+
+# STAGES (each one run with the dataset of the run and the number of workers)
+def clean_stage(dataset, workers):
+    clean_tables(workers=workers, dataset=dataset)
+
+def calendar_means_stage(dataset, workers):
+    dataset.keep(Calendar_Means(dataset.load))
+
+def tensor_stage(dataset, workers):
+    Save_Tensor(dataset.load)
+
+def flags_stage(dataset, workers):
+    dataset.keep({"city_year": Flag_Cities(dataset.load)})
+
+def quality_reports_stage(dataset, workers):
+    Quality_Plots_heatmaps(Quality_Reports(dataset.load))
+
+def daily_data_stage(dataset, workers):
+    dataset.outputs['daily_data'] = Cutting_Hourly_Values(dataset.load)
+
+def caqi_stage(dataset, workers):
+    dataset.outputs['caqi'] = CAQI_Table(Daily_Values(dataset.load))
+
+def standards_stage(dataset, workers):
+    dataset.outputs['evaluation'] = Evaluate_Standards(Daily_Values(dataset.load))
+
+def compliance_table_stage(dataset, workers):
+    Make_Compliance_Table(dataset.output('daily_data', Load_Daily_Data), dataset.output('evaluation', Load_Standards_Evaluation), dataset.load)
+
+def render_plots(jobs, workers):
+    # Independent figures, each with its own slice of data, skipped when their inputs did not change
+    print("Making Plots...")
+    jobs, keys = Stale_Plots(jobs)
+    Report_Timings(Run_Tasks(jobs, workers))
+    Save_Plot_Manifest(keys)
+
+def caqi_plots_stage(dataset, workers):
+    render_plots(CAQI_Plot_Jobs(dataset.output('caqi', Load_CAQI)), workers)
+
+def main_plots_stage(dataset, workers):
+    render_plots(Plot_Jobs(dataset.output('daily_data', Load_Daily_Data)), workers)
+
+def deepdive_plots_stage(dataset, workers):
+    render_plots(Deepdive_Plot_Jobs(config['quality_deep_locations'], dataset.load), workers)
+
+def deep_dive_tables_stage(dataset, workers):
+    Deep_Dive_table(config['quality_deep_locations'], dataset.load)   # The tables of all the cities at once, from the daily summaries
+
+RAW_FILES = ["data/raw/raw_data.csv", "data/raw/sensors.csv"]
+CLEANING_SETTINGS = [k for k in PROCESSING_CONFIG_KEYS if k != 'flags'] + [f"flags.{k}" for k in config['flags'] if k not in CITY_FLAG_KEYS]   # Same settings as the processing manifest
+RESULTS_CODE = ['results', 'standards']
+DEEP_DIVE_FILES = [f"results/quality_checks/deepdive/{city}_{table}.csv" for city in config['quality_deep_locations'] for table in ['aggregation', 'annual_mean_per_station_descriptive', 'exceedance_days_per_station_descriptive']]
+STAGES = {   # name: (function, inputs (stages or files), settings it reads, modules of its code, outputs), in the order they run
+    'clean':            (clean_stage,            RAW_FILES,                                  CLEANING_SETTINGS + ['aggregates'], ['processing', 'aggregates'],
+                         ["data/processed/manifest.json"] + [f"data/processed/{name}" for name in ['station_descriptive', 'sensor_year', 'sensor_day', 'city_day', 'city_year']]),
+    'calendar_means':   (calendar_means_stage,   ['clean'],                                  [],                                      ['processing'], ["data/processed/city_weekday", "data/processed/city_season"]),
+    'tensor':           (tensor_stage,           ['clean'],                                  ['yearfrom', 'yearto'],                  ['processing'], ["data/processed/tensor/values.npy"]),
+    'flags':            (flags_stage,            ['clean'],                                  [f"flags.{k}" for k in CITY_FLAG_KEYS],  ['processing'], ["data/processed/city_year"]),
+    'quality_reports':  (quality_reports_stage,  ['clean', 'flags', "data/raw/sensors.csv"], [],                                      ['processing'], ["results/quality_checks/cities_quality.csv", "data/descriptive/sensors_metadata.csv"]),
+    'daily_data':       (daily_data_stage,       ['clean', 'calendar_means', 'flags'],       ['locations'],                           RESULTS_CODE,   ["data/processed/daily_data.parquet"]),
+    'caqi':             (caqi_stage,             ['clean'],                                  ['CAQI_breakpoints', 'locations'],       RESULTS_CODE,   ["data/processed/caqi_daily.parquet"]),
+    'standards':        (standards_stage,        ['clean'],                                  ['standards', 'yearfrom', 'locations'],  RESULTS_CODE,   ["results/standards_compliance.csv"]),
+    'compliance_table': (compliance_table_stage, ['daily_data', 'standards', 'flags'],       ['standards'],                           RESULTS_CODE,   ["results/compliance_table.csv"]),
+    'caqi_plots':       (caqi_plots_stage,       ['caqi'],                                   ['parameters', 'locations'],             RESULTS_CODE,   ["results/plots/CAQI"]),
+    'main_plots':       (main_plots_stage,       ['daily_data'],                             ['parameters', 'standards', 'locations'], RESULTS_CODE,  ["results/plots/main", "results/plots/density_plots", "results/plots/seasonal_trends"]),
+    'deepdive_plots':   (deepdive_plots_stage,   ['clean'],                                  ['quality_deep_locations'],              RESULTS_CODE,   ["results/quality_checks/deepdive"]),
+    'deep_dive_tables': (deep_dive_tables_stage, ['clean', 'flags'],                         ['quality_deep_locations', 'standards'], RESULTS_CODE,   DEEP_DIVE_FILES),
+}
+CLEAN_STAGES = ['clean', 'calendar_means', 'tensor', 'flags', 'quality_reports']
+RESULTS_STAGES = ['daily_data', 'caqi', 'standards', 'compliance_table', 'caqi_plots', 'main_plots', 'deepdive_plots', 'deep_dive_tables']
+STAGE_MANIFEST = Path("data/processed/stages.json")                               # Key of the last run of each stage
+
+def file_fingerprint(path):
+    # Size and modification time of an input file (None when missing)
+    path = Path(path)
+    return [path.stat().st_size, path.stat().st_mtime_ns] if path.exists() else None
+
+def stage_key(name, inputs):
+    # Hash of everything a stage depends on: the keys of its inputs, the settings it reads and its code
+    function, _, settings, modules, _ = STAGES[name]
+    values = {setting: functools.reduce(lambda value, key: value.get(key) if isinstance(value, dict) else None, setting.split("."), config) for setting in settings}
+    digest = hashlib.sha256(json.dumps([name, inputs, values, inspect.getsource(function)], sort_keys=True, default=str).encode())
+    for module in modules:
+        digest.update(Path(__file__).with_name(f"{module}.py").read_bytes())
+    return digest.hexdigest()
+
+def Load_Stage_Manifest():
+    return json.loads(STAGE_MANIFEST.read_text(encoding="utf-8")) if STAGE_MANIFEST.exists() else {}
+
+def Save_Stage_Manifest(manifest):
+    STAGE_MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+    STAGE_MANIFEST.write_text(json.dumps(manifest, indent=2, ensure_ascii=False, sort_keys=True), encoding="utf-8")
+
+def Run_Stages(names, dataset=None, workers=config["pipeline"]["workers"]):
+    # Running the chosen stages in order, skipping those whose inputs, settings and code did not change since their last run
+    dataset = Dataset() if dataset is None else dataset
+    manifest = Load_Stage_Manifest()
+    keys = {}
+    ran = set()
+    for name, (function, inputs, _, _, outputs) in STAGES.items():
+        if name not in names:
+            keys[name] = manifest.get(name)                     # Outputs left as they are since their last run
+            continue
+        keys[name] = stage_key(name, [keys[i] if i in STAGES else file_fingerprint(i) for i in inputs])
+        stale = (not config["pipeline"]["stage_cache"] or manifest.get(name) != keys[name]
+                 or not all(Path(output).exists() for output in outputs) or ran & set(inputs))
+        if not stale:
+            print(f"Stage {name} unchanged, skipped")
+            continue
+        print(f"Stage {name}...")
+        manifest.pop(name, None)
+        Save_Stage_Manifest(manifest)                           # Not marked as done until it finishes
+        function(dataset, workers)
+        ran.add(name)
+        manifest[name] = keys[name]
+        Save_Stage_Manifest(manifest)
+    return ran
+
+def clean_data(workers=config["pipeline"]["workers"], dataset=None):
+    return Run_Stages([name for name in CLEAN_STAGES if name != 'tensor' or config["pipeline"]["tensor"]], dataset, workers)
+
+def get_results(workers=config["pipeline"]["workers"], dataset=None):
     print("Processing results...")
-    Cutting_Hourly_Values()
-    Make_Compliance_Table()
-    Make_Plots()
-    Quality_Plots_deepdive()
-    Deep_Dive_table()
+    ran = Run_Stages(RESULTS_STAGES, dataset, workers)
     print("Pipeline finished")
+    return ran
 
 def run_pipeline(do_fetch=config["pipeline"]["do_fetch"], do_clean=config["pipeline"]["do_clean"], do_results=config["pipeline"]["do_results"]):
+    dataset = Dataset()                                         # Tables handed over from the cleaning to the results
     if do_fetch:
         fetch_data()
     if do_clean:
-        clean_data()
+        clean_data(dataset=dataset)
     if do_results:
-        get_results()
+        get_results(dataset=dataset)
 
 
 if __name__ == "__main__":
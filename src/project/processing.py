@@ -4,38 +4,158 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 import numpy as np
 import yaml
+import shutil
+import hashlib
+import json
+from urllib.parse import quote
+from .aggregates import Day_States, Merge_States, Finalize_States
 
 with open("config.yml", "r", encoding="utf-8") as f:
     config = yaml.safe_load(f)
 
-def Clean():
+PROCESSING_CONFIG_KEYS = ['implausible_value_caps', 'cleaning', 'flags', 'timezones', 'default_timezone']   # Settings that change the processed tables
+CITY_FLAG_KEYS = ['sensors_active_per_day_high_flag', 'percent_days_avaiable_high_flag', 'sensors_active_per_day_medium_flag',
+                  'percent_days_avaiable_medium_flag', 'sensors_active_per_day_low_flag', 'percent_days_avaiable_low_flag']   # Thresholds of the city flags only (applied by Flag_Cities)
+RAW_COLUMNS = {'value': 'float64', 'parameter': 'str', 'city': 'str', 'station_name': 'str', 'sensor_id': 'int64', 'period.datetime_from.utc': 'str'}   # Raw columns used by the cleaning
+
+def Load_Clean(name, columns=None, filters=None):
+    table = pd.read_parquet(f"data/processed/{name}", engine="pyarrow", columns=columns, filters=filters)
+    for c in ['city', 'parameter']:
+        if c in table.columns:
+            table[c] = table[c].astype(str)                                         # Partition keys are read back as categories
+    if 'year' in table.columns:
+        table['year'] = table['year'].astype(int)
+    return table
+
+def Clean(raw_data=None):
     print("Cleaning Data")
 
-    raw_data = pd.read_csv("data/raw/raw_data.csv")                                                                     # Accessing raw data
+    if raw_data is None:
+        raw_data = pd.read_csv("data/raw/raw_data.csv")                                                                 # Accessing raw data
 
-    # Descritptive stats for raw data
-    Path("data/descriptive").mkdir(parents=True, exist_ok=True)
-    pre_cleaning_descriptive = raw_data.groupby(['city', 'parameter', 'station_name'])['value'].describe()                      # Descriptive stats for each sensor
-    pre_cleaning_descriptive.to_csv("data/descriptive/pre_cleaning_descriptive.csv")                                            # Saving as csv
+        # Descritptive stats for raw data
+        Path("data/descriptive").mkdir(parents=True, exist_ok=True)
+        pre_cleaning_descriptive = raw_data.groupby(['city', 'parameter', 'station_name'])['value'].describe()                  # Descriptive stats for each sensor
+        pre_cleaning_descriptive.to_csv("data/descriptive/pre_cleaning_descriptive.csv")                                        # Saving as csv
 
     # Convert to datetime
     raw_data["period.datetime_from.utc"] = pd.to_datetime(raw_data["period.datetime_from.utc"], format='ISO8601', utc=True)     # Convert to datetime format
     raw_data.rename(columns= {"period.datetime_from.utc" : "utc_datetime"}, inplace=True)                                       # Rename utc_datetime
-    raw_data['local_datetime'] = raw_data['utc_datetime'].dt.tz_convert('Europe/Rome')                                          # Creating local_datetime variable
+    raw_data['timezone'] = City_Timezones(raw_data).astype('category')                                                          # Timezone of each city
+    raw_data['local_datetime'] = Local_Datetime(raw_data['utc_datetime'], raw_data['timezone'])                                 # Creating local_datetime variable (local wall-clock time)
     
-    # Basic cleaning
-    raw_data.drop_duplicates(inplace=True)                                                                                      # Drop duplicates
-    raw_data.dropna(subset=['value', 'utc_datetime'], inplace=True)                                                 # Drop NA for measurements or date
-    raw_data.drop(raw_data[raw_data.value < 0].index, inplace=True)                                                             # Exclude neagtive values
-    for parameter, cap in config['implausible_value_caps'].items():
-        implausble_values = raw_data[(raw_data['parameter'] == parameter) & (raw_data.value > cap)].index
-        raw_data.drop(implausble_values, inplace=True)                                                             # Exclude implausibly high values
+    # Cleaning rules (see config "cleaning"), all evaluated on the raw rows at once
+    rejected = pd.DataFrame({name: Rule_Mask(raw_data, rule) for name, rule in config['cleaning']['rules'].items()}, index=raw_data.index)
+    valid = ~rejected.any(axis=1).to_numpy()
+    rejected['duplicate'] = False
+    rejected.loc[valid, 'duplicate'] = raw_data.loc[valid, config['cleaning']['duplicate_key']].duplicated().to_numpy()   # Same measurement already kept
+    rejected['kept'] = valid & ~rejected['duplicate'].to_numpy()
+    rejections = rejected.groupby([raw_data['city'], raw_data['parameter']]).sum().rename_axis(columns='rule').stack().reset_index(name='rows')   # Rows removed by each rule
 
-    clean_data = raw_data[['value', 'parameter', 'city', 'station_name', 'sensor_id', 'utc_datetime', 'local_datetime']].copy() # Creating clean_df with selected columns
+    clean_data = raw_data.loc[rejected['kept'], ['value', 'parameter', 'city', 'station_name', 'sensor_id', 'utc_datetime', 'local_datetime', 'timezone']].copy() # Creating clean_df with selected columns
 
     print("Done!")
-    return clean_data
+    return clean_data, rejections
+
+def Rule_Mask(raw_data, rule):
+    # Rows rejected by one cleaning rule
+    column = raw_data[rule['column']]
+    if rule['check'] == 'missing':
+        return column.isna()
+    if rule['check'] == 'flatline':
+        return Flatline(raw_data, rule['column'], rule['hours'])
+    limit = rule['limit']
+    if isinstance(limit, dict):
+        limit = raw_data['parameter'].map(limit)                                   # One limit for each parameter (none for the others)
+    if rule['check'] == 'below':
+        return column < limit
+    if rule['check'] == 'above':
+        return column > limit
+    raise ValueError(f"Unknown cleaning check: {rule['check']}")
+
+def Flatline(raw_data, column, hours):
+    # Rows in runs of at least `hours` consecutive hourly measurements of a sensor with the same value (duplicated rows counted once)
+    sensor = raw_data['sensor_id'].to_numpy()
+    time = raw_data['utc_datetime'].dt.as_unit('ns').astype('int64').to_numpy()
+    order = np.lexsort((time, sensor))
+    sensor, time, value = sensor[order], time[order], raw_data[column].to_numpy()[order]
+    same = (sensor[1:] == sensor[:-1]) & (value[1:] == value[:-1]) & (time[1:] - time[:-1] <= pd.Timedelta(hours=1).value)
+    run = np.concatenate([[0], np.cumsum(~same)])                                  # Run of each sorted row
+    new_hour = np.concatenate([[True], (sensor[1:] != sensor[:-1]) | (time[1:] != time[:-1])])   # First row of each sensor and hour
+    flat = np.empty(len(order), dtype=bool)
+    flat[order] = np.bincount(run, weights=new_hour)[run] >= hours                 # Distinct hours of each run
+    return pd.Series(flat, index=raw_data.index)
+
+def Save_Rejections(rejections):
+    Path("data/descriptive").mkdir(parents=True, exist_ok=True)
+    rejections = pd.concat(rejections).groupby(['city', 'parameter', 'rule'], sort=False)['rows'].sum().reset_index()   # Summing the chunks
+    rejections.to_csv("data/descriptive/cleaning_rejections.csv", index=False)
+
+
+def City_Timezones(raw_data):
+    # Timezone of each row's city: from config, otherwise the most common one among the city's stations in the sensors metadata
+    timezones = {}
+    if Path("data/raw/sensors.csv").exists():
+        sensors = pd.read_csv("data/raw/sensors.csv", usecols=['name', 'timezone']).rename(columns={'name': 'station_name'}).drop_duplicates('station_name')
+        stations = raw_data[['city', 'station_name']].drop_duplicates().merge(sensors, on='station_name').dropna()
+        timezones = stations.groupby('city')['timezone'].agg(lambda x: x.mode()[0]).to_dict()
+    timezones.update(config['timezones'] or {})
+    return raw_data['city'].map(timezones).fillna(config['default_timezone'])
+
+def Local_Datetime(utc_datetime, timezones):
+    # Local wall-clock time, converting all the rows sharing a timezone at once
+    local_datetime = utc_datetime.dt.tz_localize(None).copy()
+    for tz in timezones.unique():
+        rows = (timezones == tz).to_numpy()
+        local_datetime.loc[rows] = utc_datetime[rows].dt.tz_convert(tz).dt.tz_localize(None)
+    return local_datetime
+
+def Partition_Raw(chunk_rows=config["pipeline"]["chunk_rows"]):
+    # Streaming the raw csv into one parquet folder for each (city, parameter, local year)
+    print("Partitioning raw data...")
+    shutil.rmtree("data/raw/partitioned", ignore_errors=True)
+    shutil.rmtree("data/raw/undated", ignore_errors=True)
+    partitions = set()
+    chunks = pd.read_csv("data/raw/raw_data.csv", usecols=list(RAW_COLUMNS), dtype=RAW_COLUMNS, chunksize=chunk_rows)
+    for n, chunk in enumerate(chunks):
+        utc_datetime = pd.to_datetime(chunk["period.datetime_from.utc"], format='ISO8601', utc=True)
+        chunk['year'] = Local_Datetime(utc_datetime, City_Timezones(chunk)).dt.year.astype('Int64')
+        undated = chunk['year'].isna().to_numpy()
+        if undated.any():
+            Path("data/raw/undated").mkdir(parents=True, exist_ok=True)
+            chunk[undated].drop(columns='year').to_parquet(f"data/raw/undated/chunk-{n:05d}.parquet", engine="pyarrow", index=False)   # Missing dates, only counted by the cleaning rules
+        chunk = chunk[~undated]
+        partitions.update(chunk[['city', 'parameter', 'year']].drop_duplicates().itertuples(index=False, name=None))
+        chunk.to_parquet("data/raw/partitioned", engine="pyarrow", index=False,
+                         partition_cols=['city', 'parameter', 'year'],
+                         basename_template=f"chunk-{n:05d}-{{i}}.parquet")      # Zero padded so files are read back in csv order
+
+    # Descritptive stats for raw data, one city and parameter at a time
+    Path("data/descriptive").mkdir(parents=True, exist_ok=True)
+    undated = Load_Raw_Undated()
+    pre_cleaning_descriptive = []
+    for city, parameter in sorted({(city, parameter) for city, parameter, year in partitions} | set(zip(undated['city'], undated['parameter']))):
+        raw_data = pd.read_parquet("data/raw/partitioned", columns=['station_name', 'value'], filters=[('city', '=', city), ('parameter', '=', parameter)])
+        raw_data = pd.concat([raw_data, undated.loc[(undated['city'] == city) & (undated['parameter'] == parameter), ['station_name', 'value']]], ignore_index=True)
+        describe = raw_data.groupby('station_name')['value'].describe()
+        pre_cleaning_descriptive.append(pd.concat({(city, parameter): describe}, names=['city', 'parameter']))
+    pd.concat(pre_cleaning_descriptive).to_csv("data/descriptive/pre_cleaning_descriptive.csv")
 
+    print("Done!")
+    return sorted((city, parameter, int(year)) for city, parameter, year in partitions)
+
+def Load_Raw_Partition(city, parameter, year):
+    raw_data = pd.read_parquet("data/raw/partitioned", engine="pyarrow", columns=list(RAW_COLUMNS),
+                               filters=[('city', '=', city), ('parameter', '=', parameter), ('year', '=', year)])
+    raw_data['city'] = raw_data['city'].astype(str)                              # Partition keys are read back as categories
+    raw_data['parameter'] = raw_data['parameter'].astype(str)
+    return raw_data
+
+def Load_Raw_Undated():
+    # Raw rows without a date (in no partition), still counted by the cleaning rules
+    if not Path("data/raw/undated").exists():
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in RAW_COLUMNS.items()})
+    return pd.read_parquet("data/raw/undated", engine="pyarrow", columns=list(RAW_COLUMNS))
 
 
 def Get_Season(row):                                        # Function for getting the season
@@ -68,21 +188,67 @@ def Time_Aggregation(clean_data):
     return clean_data
 
 
-def Flag_City(x):
-
-    if x['year_median_active_sensors_per_city_parameter'] >= config["flags"]["sensors_active_per_day_high_flag"] and x['percent_days_avaiable_per_city_year'] >= config["flags"]["percent_days_avaiable_high_flag"]:
-        flag = "High"
-
-    elif x['year_median_active_sensors_per_city_parameter'] >= config["flags"]["sensors_active_per_day_medium_flag"] and x['percent_days_avaiable_per_city_year'] >= config["flags"]["percent_days_avaiable_medium_flag"]:
-        flag = "Medium"
-
-    elif x['year_median_active_sensors_per_city_parameter'] >= config["flags"]["sensors_active_per_day_low_flag"] or x['percent_days_avaiable_per_city_year'] >= config["flags"]["percent_days_avaiable_low_flag"]:
-        flag = "Low"
-
-    else:
-        flag = "Very Low"
-
-    return flag
+def Flag_City(city_year):
+    # Quality flag of each city, parameter and year from its median active sensors and percent days available
+    flags = config["flags"]
+    sensors = city_year['year_median_active_sensors_per_city_parameter']
+    days = city_year['percent_days_avaiable_per_city_year']
+    return np.select(
+        [(sensors >= flags["sensors_active_per_day_high_flag"]) & (days >= flags["percent_days_avaiable_high_flag"]),
+         (sensors >= flags["sensors_active_per_day_medium_flag"]) & (days >= flags["percent_days_avaiable_medium_flag"]),
+         (sensors >= flags["sensors_active_per_day_low_flag"]) | (days >= flags["percent_days_avaiable_low_flag"])],
+        ["High", "Medium", "Low"], "Very Low")
+
+def Flag_Cities(load=Load_Clean):
+    # Flags set on the stored yearly table, so that changing their thresholds does not need the cleaning again
+    print("Flagging cities...")
+    city_year = load("city_year").drop(columns='flag_city_parameter', errors='ignore')
+    city_year.insert(city_year.columns.get_loc('percent_days_avaiable_per_city_year') + 1, 'flag_city_parameter', Flag_City(city_year))
+    Save_Clean({"city_year": city_year})
+    return city_year
+
+
+def Local_Hours(clean_data):
+    # Hours elapsed since local midnight and length of the local day (23/25 hours on DST changes), one batch for each timezone
+    hours = np.empty(len(clean_data), dtype=np.int64)
+    day_length = np.empty(len(clean_data), dtype=np.int64)
+    for tz in clean_data['timezone'].unique():
+        rows = (clean_data['timezone'] == tz).to_numpy()
+        midnight = clean_data['local_datetime'][rows].dt.normalize()
+        start = midnight.dt.tz_localize(tz, ambiguous=True, nonexistent='shift_forward')
+        end = (midnight + pd.Timedelta(days=1)).dt.tz_localize(tz, ambiguous=True, nonexistent='shift_forward')
+        hours[rows] = (clean_data['utc_datetime'][rows] - start) // pd.Timedelta(hours=1)
+        day_length[rows] = (end - start) // pd.Timedelta(hours=1)
+    return hours, day_length
+
+def Coverage_Index(clean_data):
+    # One bitmask for each (sensor, local day): bit h is set when the sensor measured h hours after local midnight
+    hours, day_length = Local_Hours(clean_data)
+    clean_data['local_hour'] = hours                                                            # Kept for the daily states
+    groups = clean_data.groupby(['city', 'parameter', 'station_name', 'sensor_id', 'year', 'day'], sort=True)
+    codes = groups.ngroup().to_numpy()                                                          # Sensor-day of each hourly row
+
+    masks = np.zeros(groups.ngroups, dtype=np.uint32)
+    np.bitwise_or.at(masks, codes, (1 << hours).astype(np.uint32))
+    lengths = np.zeros(groups.ngroups, dtype=np.uint8)
+    lengths[codes] = day_length
+
+    coverage = groups.size().index.to_frame(index=False)
+    coverage['hours_mask'] = masks
+    coverage['day_length'] = lengths
+    return coverage, codes
+
+def Coverage_Hours(masks):
+    return np.bitwise_count(masks)                                                              # Measured hours in each day
+
+def Longest_Gap(masks, day_length):
+    # Longest run of missing hours within each day, shifting the missing bits onto themselves
+    gaps = ~masks & ((np.uint32(1) << day_length.astype(np.uint32)) - np.uint32(1))
+    longest = np.zeros(len(masks), dtype=np.int64)
+    while gaps.any():
+        longest += gaps > 0
+        gaps &= gaps >> np.uint32(1)
+    return longest
 
 
 def Quality_Checks(clean_data):
@@ -91,36 +257,34 @@ def Quality_Checks(clean_data):
 
     # SENSORS
 
-    clean_data['sensor_percent_coverage_per_day'] = round((clean_data.groupby(
-        ['day', 'sensor_id'])['local_datetime'].transform('nunique') / 24) * 100, 2)    
+    coverage, coverage_codes = Coverage_Index(clean_data)
+    coverage['sensor_percent_coverage_per_day'] = np.round(Coverage_Hours(coverage['hours_mask'].to_numpy()) / 24 * 100, 2)
+    coverage['longest_gap_hours'] = Longest_Gap(coverage['hours_mask'].to_numpy(), coverage['day_length'].to_numpy())
+    sensor_year_keys = ['year', 'city', 'parameter', 'station_name', 'sensor_id']
+    coverage['sensors_percent_coverage_per_year'] = np.round(coverage.groupby(sensor_year_keys)['day'].transform('size') / 365 * 100, 2)   # Days measured by each sensor in the year
+
+    clean_data['sensor_percent_coverage_per_day'] = coverage['sensor_percent_coverage_per_day'].to_numpy()[coverage_codes]
     
     clean_data['mean_sensor_percent_coverage_per_day'] = round(clean_data.groupby(
         ['sensor_id', 'year'])['sensor_percent_coverage_per_day'].transform('mean'), 2)        # Creating a variable for sensors day coverage percent
 
-    clean_data['sensors_percent_coverage_per_year'] = round((clean_data.groupby(
-        ['year', 'city', 'parameter', 'station_name', 'sensor_id'])['day'].transform('nunique') / 365) *100, 2)               # Creating a variable for sensors percent coverage for year
+    clean_data['sensors_percent_coverage_per_year'] = coverage['sensors_percent_coverage_per_year'].to_numpy()[coverage_codes]   # Creating a variable for sensors percent coverage for year
 
     clean_data['valid_sensor'] = ((clean_data['sensors_percent_coverage_per_year'] >= config["flags"]["percent_coverage_valid_sensor"])
                                             & (clean_data['mean_sensor_percent_coverage_per_day'] >= config["flags"]["percent_daily_coverage_valid_sensor"]))           # Selecting valid sensors
     
-    # SENSORS METADATA
-    sensors_per_parameter = clean_data[['city', 'station_name', 'parameter', 'sensor_id']].drop_duplicates().copy()
-    sensors = pd.read_csv("data/raw/sensors.csv")
-    sensors = sensors.drop(columns=['instruments', 'sensors', 'country.id', 'country.code', 'owner.id', 'provider.id', 'datetime_first.utc', 'datetime_last.utc', 'id', 'bounds'])
-    sensors = sensors.rename(columns={"name" : "station_name", "country.name" : "country", "owner.name" : "owner", "provider.name" : "provider", "coordinates.latitude" : "latitude", "coordinates.longitude" : "longitude", "datetime_first.local" : "datetime_from", "datetime_last.local" : "datetime_to"})
-    sensors = sensors_per_parameter.merge(sensors, how="left", on='station_name')
-    
-    # SAVING DATAFRAMES
-
-    print("Saving quality checks dataframes...")
-    processed_decriptive = clean_data.groupby(['year', 'city', 'parameter', 'station_name'])['value'].describe()
-    processed_decriptive.to_csv("data/descriptive/processed_descriptive.csv")
-
-    quality_checks_sensors = clean_data.groupby(['year', 'city', 'parameter', 'station_name', 'sensor_id'])[['mean_sensor_percent_coverage_per_day' ,'sensors_percent_coverage_per_year', 'valid_sensor']].first()
-    quality_checks_sensors = pd.DataFrame(quality_checks_sensors)
-    quality_checks_sensors.to_csv("results/quality_checks/sensors_quality.csv")
-
-    sensors.to_csv("data/descriptive/sensors_metadata.csv", index=False)
+    # SENSORS AND STATIONS TABLES (before exclusions)
+    station_descriptive = clean_data.groupby(['year', 'city', 'parameter', 'station_name'])['value'].describe().reset_index()
+    sensor_year = clean_data.groupby(sensor_year_keys)[['mean_sensor_percent_coverage_per_day' ,'sensors_percent_coverage_per_year', 'valid_sensor']].first()
+    sensor_year['max_daily_gap_hours'] = coverage.groupby(sensor_year_keys)['longest_gap_hours'].max()
+    sensor_year = sensor_year.reset_index()
+
+    # Sensor-days kept after the exclusions below
+    coverage['included'] = True
+    if config["flags"]["exclude_invalid_sensors"]:
+        coverage['included'] &= coverage.join(sensor_year.set_index(sensor_year_keys)['valid_sensor'], on=sensor_year_keys)['valid_sensor'].to_numpy()
+    if config["flags"]["exclude_invalid_days"]:
+        coverage['included'] &= coverage['sensor_percent_coverage_per_day'] >= config["flags"]["percent_coverage_valid_day"]
 
     # EXCLUDING INVALID SENSORS
     if config["flags"]["exclude_invalid_sensors"]:
@@ -132,34 +296,53 @@ def Quality_Checks(clean_data):
 
     # CITIES
 
-    clean_data['active_sensors_per_day_city_parameter'] = clean_data.groupby(
-        ['day', 'city', 'parameter'])['sensor_id'].transform('nunique')                                     # Creating a variable for active sensors per day in each city for each parameter
+    included = coverage[coverage['included']]
+    active_sensors = included.groupby(['city', 'parameter', 'day']).size()                                 # Sensor-days left in each city-day
+    city_days = pd.MultiIndex.from_frame(clean_data[['city', 'parameter', 'day']])
+    clean_data['active_sensors_per_day_city_parameter'] = active_sensors.reindex(city_days).to_numpy()      # Creating a variable for active sensors per day in each city for each parameter
 
     clean_data['year_median_active_sensors_per_city_parameter'] = clean_data.groupby(
         ['city', 'parameter', 'year'])['active_sensors_per_day_city_parameter'].transform('median')          # Creating a variable for median acrive sensor per year (city and parameter)
 
-    clean_data['percent_days_avaiable_per_city_year'] = round((clean_data.groupby(['city', 'parameter', 'year'])['day'].transform('nunique') / 365) * 100, 2)
+    days_available = included.groupby(['city', 'parameter', 'year'])['day'].nunique()
+    city_years = pd.MultiIndex.from_frame(clean_data[['city', 'parameter', 'year']])
+    clean_data['percent_days_avaiable_per_city_year'] = np.round(days_available.reindex(city_years).to_numpy() / 365 * 100, 2)
 
- 
-    clean_data['flag_city_parameter'] = clean_data.apply(Flag_City, axis=1)                                # Flagging cities
+    sensor_coverage = coverage[['city', 'parameter', 'station_name', 'sensor_id', 'year', 'day', 'hours_mask', 'day_length', 'included']]
+    return clean_data, {"station_descriptive": station_descriptive, "sensor_year": sensor_year, "sensor_coverage": sensor_coverage}
 
-    # SAVING DATAFRAME
 
-    quality_checks_city = clean_data.groupby(['city', 'year', 'parameter'])[['year_median_active_sensors_per_city_parameter', 'percent_days_avaiable_per_city_year', 'flag_city_parameter']].first()
-    quality_checks_city = pd.DataFrame(quality_checks_city)
+def Quality_Reports(load=Load_Clean):
+    print("Saving quality checks dataframes...")
+    Path("data/descriptive").mkdir(parents=True, exist_ok=True)
     Path("results/quality_checks").mkdir(parents=True, exist_ok=True)
-    quality_checks_city.to_csv("results/quality_checks/cities_quality.csv")
 
-    return clean_data
+    processed_decriptive = load("station_descriptive").set_index(['year', 'city', 'parameter', 'station_name']).sort_index()
+    processed_decriptive.to_csv("data/descriptive/processed_descriptive.csv")
+
+    quality_checks_sensors = load("sensor_year").set_index(['year', 'city', 'parameter', 'station_name', 'sensor_id']).sort_index()
+    quality_checks_sensors.to_csv("results/quality_checks/sensors_quality.csv")
+
+    # SENSORS METADATA
+    sensors_per_parameter = quality_checks_sensors.reset_index()[['city', 'station_name', 'parameter', 'sensor_id']].drop_duplicates()
+    sensors = pd.read_csv("data/raw/sensors.csv")
+    sensors = sensors.drop(columns=['instruments', 'sensors', 'country.id', 'country.code', 'owner.id', 'provider.id', 'datetime_first.utc', 'datetime_last.utc', 'id', 'bounds'])
+    sensors = sensors.rename(columns={"name" : "station_name", "country.name" : "country", "owner.name" : "owner", "provider.name" : "provider", "coordinates.latitude" : "latitude", "coordinates.longitude" : "longitude", "datetime_first.local" : "datetime_from", "datetime_last.local" : "datetime_to"})
+    sensors = sensors_per_parameter.merge(sensors, how="left", on='station_name')
+    sensors.to_csv("data/descriptive/sensors_metadata.csv", index=False)
 
+    quality_checks_city = load("city_year").set_index(['city', 'year', 'parameter']).sort_index()
+    quality_checks_city = quality_checks_city[['year_median_active_sensors_per_city_parameter', 'percent_days_avaiable_per_city_year', 'flag_city_parameter']]
+    quality_checks_city.to_csv("results/quality_checks/cities_quality.csv")
+    return quality_checks_city.reset_index()
 
 
 
-def Quality_Plots_heatmaps():
+def Quality_Plots_heatmaps(quality_checks_city=None):
     # CITIES QUALITY HEATMAPS
     print("Creating plots...")
     Path("results/quality_checks/figures").mkdir(parents=True, exist_ok=True)
-    c = pd.read_csv("results/quality_checks/cities_quality.csv")
+    c = pd.read_csv("results/quality_checks/cities_quality.csv") if quality_checks_city is None else quality_checks_city
 
     pivot_quality_active_sensors = c.pivot(index=['city', 'year'], columns='parameter', values='year_median_active_sensors_per_city_parameter')
     figure, ax = plt.subplots(figsize=(10, 8))
@@ -178,74 +361,299 @@ def Quality_Plots_heatmaps():
     plt.close()
     
 
-def add_roll_and_mda8(g, tz_local="Europe/Rome"):
-
-    g = g.sort_values("utc_datetime")
-
-    s = (g.drop_duplicates("utc_datetime")
-            .set_index("utc_datetime")["median_hourly_value"]
-            .asfreq("h"))
-
-    r8 = s.rolling(8, min_periods=6).mean()
-    day_local = r8.index.tz_convert(tz_local).floor("D")
-    mda8 = r8.groupby(day_local).max()
-
-    total = pd.Series(1, index=r8.index).groupby(day_local).sum()
-    valid = r8.notna().groupby(day_local).sum()
-    thresh = np.ceil(total * 0.75).astype(int)   # gestisce DST (23/25 ore)
-    mda8_valid = mda8.where(valid >= thresh)
-
-    hourly_out = pd.DataFrame({"utc_datetime": r8.index, "rolling_8h_mean": r8.values})
-
-       
-    daily_out = pd.DataFrame({"day": mda8_valid.index.date, "mda8": mda8_valid.values})
-        
-    return hourly_out, daily_out
+def hourly_grid(data, keys):
+    codes = data.groupby(keys, sort=True).ngroup().to_numpy()                      # One series for each group of keys
+    t0 = data["utc_datetime"].min()
+    pos = ((data["utc_datetime"] - t0) // pd.Timedelta(hours=1)).to_numpy()        # Position of each row on the common hourly grid
+    return codes, pos, t0
+
+def roll_and_mda8(codes, pos, values, series_tz, t0):
+    # Rolling 8h mean and MDA8 of each (series, hour) cell, for all the series at once
+    n_series = codes.max() + 1
+    n_hours = pos.max() + 1
+
+    grid = np.full((n_hours, n_series), np.nan)                                    # 2-D array hours x series, NaN for gaps
+    grid[pos, codes] = values
+
+    first = np.full(n_series, n_hours)
+    last = np.full(n_series, -1)
+    np.minimum.at(first, codes, pos)
+    np.maximum.at(last, codes, pos)
+    hours = np.arange(n_hours)[:, None]
+    in_span = (hours >= first) & (hours <= last)                                   # Hours between first and last measurement of each series
+
+    r8 = pd.DataFrame(grid).rolling(8, min_periods=6).mean().to_numpy()            # Rolling 8h mean for all the series at once
+    r8[~in_span] = np.nan
+
+    grid_index = pd.date_range(t0, periods=n_hours, freq="h")
+    series_tz = pd.Series(series_tz)                                               # Timezone of each series
+    mda8_per_row = np.full(len(codes), np.nan)
+
+    for tz, columns in series_tz.groupby(series_tz).groups.items():                # One batch for all the series sharing a timezone
+        columns = np.asarray(columns)
+        day_codes, days = pd.factorize(grid_index.tz_convert(tz).tz_localize(None).normalize())   # Local day of each hour of the grid
+        mda8 = pd.DataFrame(r8[:, columns]).groupby(day_codes).max().to_numpy()
+        total = pd.DataFrame(in_span[:, columns]).groupby(day_codes).sum().to_numpy()
+        valid = pd.DataFrame(~np.isnan(r8[:, columns])).groupby(day_codes).sum().to_numpy()
+        thresh = np.ceil(total * 0.75).astype(int)                                 # gestisce DST (23/25 ore)
+        mda8_valid = np.where(valid >= thresh, mda8, np.nan)
+
+        slot = np.full(n_series, -1)
+        slot[columns] = np.arange(len(columns))                                    # Column of each series in the batch
+        rows = slot[codes] >= 0
+        mda8_per_row[rows] = mda8_valid[day_codes[pos[rows]], slot[codes[rows]]]
+
+    rolling_8h_mean = r8[pos, codes]                                               # Back to the rows without merging
+
+    return rolling_8h_mean, mda8_per_row
+
+def group_median(codes, values, n_groups):
+    # Exact median of each group, for many small groups: one row per group, sorted along the rows, then the middle element(s)
+    sizes = np.bincount(codes, minlength=n_groups)
+    occupied = np.flatnonzero(sizes)
+    rows = np.zeros(n_groups, dtype=np.int64)
+    rows[occupied] = np.arange(len(occupied))                                      # Row of each non empty group
+
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    slot = np.arange(len(codes)) - (np.cumsum(sizes) - sizes)[sorted_codes]       # Position of each value within its group
+    table = np.full((len(occupied), sizes.max()), np.nan)
+    table[rows[sorted_codes], slot] = values[order]
+    table.sort(axis=1)                                                             # NaN are sorted last
+
+    counts = (~np.isnan(table)).sum(axis=1)
+    medians = np.full(n_groups, np.nan)
+    has = counts > 0
+    low = table[has, (counts[has] - 1) // 2]
+    high = table[has, counts[has] // 2]
+    medians[occupied[has]] = (low + high) / 2
+    return medians
+
+def Daily_Tables(clean_data, mda8, station_mda8, sensor_states):
+    city_keys = ['city', 'parameter']
+    station_keys = ['day', 'city', 'parameter', 'station_name']
+
+    # Daily values per station (mean and max merging the states of its sensors, exact median from the hourly rows)
+    station_codes = clean_data.groupby(station_keys).ngroup().to_numpy()                # Station-day of each hourly row
+    station_day = Finalize_States(Merge_States(sensor_states, station_keys, sketch=False), median=False).set_index(station_keys)
+    station_day['median_value'] = group_median(station_codes, clean_data['value'].to_numpy(dtype=float), len(station_day))   # The sketches are approximate above their size
+    station_day = station_day[['mean_value', 'max_value', 'median_value']].rename(columns=lambda c: f"day_{c}_per_station")
+    station_day['mda8_per_station'] = np.nan
+    station_day.iloc[station_codes, station_day.columns.get_loc('mda8_per_station')] = station_mda8   # Constant within each station-day
+
+    # Daily values per city (aggregating the station values over the hourly rows)
+    per_row = pd.DataFrame(station_day.to_numpy()[station_codes], columns=station_day.columns, index=clean_data.index)
+    city_groups = per_row.groupby([clean_data['day'], clean_data['city'], clean_data['parameter']])
+    city_codes = city_groups.ngroup().to_numpy()                                        # City-day of each hourly row
+    city_day = city_groups.agg(day_mean_value=('day_mean_value_per_station', 'mean'), day_max_value=('day_max_value_per_station', 'max'), day_median_value=('day_median_value_per_station', 'median'))
+    city_day['mda8'] = np.nan
+    city_day.iloc[city_codes, city_day.columns.get_loc('mda8')] = mda8                  # MDA8 is constant within each city-day
+
+    # Yearly averages
+    day_mean_value = city_day['day_mean_value'].to_numpy()[city_codes]
+    city_year = pd.Series(day_mean_value).groupby([clean_data['city'].to_numpy(), clean_data['parameter'].to_numpy(), clean_data['year'].to_numpy()]).mean()
+
+    # NORMALIZED TABLES
+    sensor_day = Finalize_States(sensor_states, median=False)
+    sensor_day['sensor_percent_coverage_per_day'] = np.round(sensor_day['measured_hours'] / 24 * 100, 2)
+    sensor_day = sensor_day[['city', 'parameter', 'station_name', 'sensor_id', 'day', 'year', 'n_hours', 'sensor_percent_coverage_per_day']]
+    sensor_day = sensor_day.join(station_day.reorder_levels(['city', 'parameter', 'station_name', 'day']), on=['city', 'parameter', 'station_name', 'day'])
+
+    city_calendar = clean_data.groupby(city_keys + ['day']).agg(
+        year=('year', 'first'),
+        day_of_the_week=('day_of_the_week', 'first'),
+        season=('season', 'first'),
+        n_hours=('value', 'size'),
+        active_sensors_per_day_city_parameter=('active_sensors_per_day_city_parameter', 'first'))
+    city_day = city_calendar.join(city_day.reorder_levels(['city', 'parameter', 'day']), on=['city', 'parameter', 'day']).reset_index()
+
+    city_year = city_year.rename_axis(city_keys + ['year']).rename('mean_value_per_year')
+    city_quality = clean_data.groupby(city_keys + ['year'])[['year_median_active_sensors_per_city_parameter', 'percent_days_avaiable_per_city_year']].first()
+    city_year = city_quality.join(city_year).reset_index()
+
+    return sensor_day, city_day, city_year
 
 def Calculate_Average_Values(clean_data):
     print("Calculating average values...")
 
-    # Daily means
-    clean_data['day_mean_value_per_station'] = clean_data.groupby(['day', 'city', 'parameter', 'station_name'])['value'].transform('mean')
-    clean_data['day_mean_value'] = clean_data.groupby(['day', 'city', 'parameter'])['day_mean_value_per_station'].transform('mean')
-
-    # Max values (needed for o3 and no2)
-    clean_data['day_max_value_per_station'] = clean_data.groupby(['day', 'city', 'parameter', 'station_name'])['value'].transform('max')
-    clean_data['day_max_value'] = clean_data.groupby(['day', 'city', 'parameter'])['day_max_value_per_station'].transform('max')
-    
-    # Seasonal, week day and yearly averages
-    clean_data['mean_value_per_weekday'] = clean_data.groupby(['day_of_the_week', 'city', 'parameter'])['day_mean_value'].transform('mean')
-    clean_data['mean_value_per_season'] = clean_data.groupby(['season', 'city', 'parameter'])['day_mean_value'].transform('mean')
-    clean_data['mean_value_per_year'] = clean_data.groupby(['year', 'city', 'parameter'])['day_mean_value'].transform('mean')
-
-    # Median values
-    clean_data["median_hourly_value"] = (clean_data.groupby(["city", "parameter", "utc_datetime"])["value"].transform("median"))
-    clean_data["day_median_value_per_station"] = clean_data.groupby(['day', 'city', 'parameter', 'station_name'])['value'].transform('median')
-    clean_data['day_median_value'] = clean_data.groupby(['day', 'city', 'parameter'])['day_median_value_per_station'].transform('median')
-    
-    # Add rolling 8h mean and max rolling 8h mean
-    hourly_tbl = []
-    daily_tbl = []
-
-    for (city, param), g in clean_data.groupby(["city", "parameter"]):
-        h, d = add_roll_and_mda8(g)
-        h["city"], h["parameter"] = city, param
-        d["city"], d["parameter"] = city, param
-        hourly_tbl.append(h)
-        daily_tbl.append(d)
-
-    hourly_tbl = pd.concat(hourly_tbl, ignore_index=True)
-    daily_tbl  = pd.concat(daily_tbl,  ignore_index=True)
+    # Median values (one cell of the hourly grid for each city, parameter and hour)
+    grid = hourly_grid(clean_data, ['city', 'parameter'])
+    series_codes, pos, t0 = grid
+    cells = pos * (series_codes.max() + 1) + series_codes
+    clean_data["median_hourly_value"] = group_median(cells, clean_data['value'].to_numpy(dtype=float), cells.max() + 1)[cells]
+
+    # Station series on the same grid (hourly mean of the station's sensors)
+    station_codes = clean_data.groupby(['city', 'parameter', 'station_name'], sort=True).ngroup().to_numpy()
+    n_stations = station_codes.max() + 1
+    station_cells, station_rows = np.unique(pos * n_stations + station_codes, return_inverse=True)   # One cell for each station and hour
+    station_values = np.bincount(station_rows, weights=clean_data['value'].to_numpy(dtype=float)) / np.bincount(station_rows)
+
+    # Add rolling 8h mean and max rolling 8h mean, for the city and the station series in one batch
+    timezone = pd.Series(clean_data['timezone'].to_numpy())
+    series_tz = np.concatenate([timezone.groupby(series_codes).first().to_numpy(), timezone.groupby(station_codes).first().to_numpy()])
+    r8, mda8 = roll_and_mda8(np.concatenate([series_codes, series_codes.max() + 1 + station_cells % n_stations]),
+                             np.concatenate([pos, station_cells // n_stations]),
+                             np.concatenate([clean_data['median_hourly_value'].to_numpy(), station_values]),
+                             series_tz, t0)
+    clean_data['rolling_8h_mean'] = r8[:len(clean_data)]
+    station_mda8 = mda8[len(clean_data):][station_rows]                            # Back to the hourly rows
+    mda8 = mda8[:len(clean_data)]
+
+    # Mergeable daily states of each sensor (persisted, so that partial results can be combined)
+    sensor_states = Day_States(clean_data, ['city', 'parameter', 'station_name', 'sensor_id', 'day', 'year'], clean_data['local_hour'].to_numpy())
+
+    # Daily and yearly tables
+    sensor_day, city_day, city_year = Daily_Tables(clean_data, mda8, station_mda8, sensor_states)
+
+    hourly = clean_data[['value', 'parameter', 'city', 'station_name', 'sensor_id', 'utc_datetime', 'local_datetime', 'day', 'year', 'median_hourly_value', 'rolling_8h_mean']].reset_index(drop=True)
 
-    clean_data = clean_data.merge(hourly_tbl, on=["city", "parameter", "utc_datetime"], how="left")
-    clean_data = clean_data.merge(daily_tbl, on=["city", "parameter", "day"], how="left")
+    print("Done!")
+    return {
+        "clean": hourly,
+        "sensor_day": sensor_day,
+        "sensor_day_state": sensor_states,
+        "city_day": city_day,
+        "city_year": city_year,
+    }
+
+def Calendar_Means(load=Load_Clean):
+    # Seasonal and week day averages over all the years (weighting each day by its hourly rows)
+    city_day = load("city_day", columns=['city', 'parameter', 'day_of_the_week', 'season', 'n_hours', 'day_mean_value'])
+    city_day['weighted_value'] = city_day['day_mean_value'] * city_day['n_hours']
+
+    tables = {}
+    for name, period, column in [("city_weekday", 'day_of_the_week', 'mean_value_per_weekday'), ("city_season", 'season', 'mean_value_per_season')]:
+        sums = city_day.groupby(['city', 'parameter', period])[['weighted_value', 'n_hours']].sum()
+        tables[name] = (sums['weighted_value'] / sums['n_hours']).rename(column).reset_index()
+
+    Save_Clean(tables)
+    return tables
+
+def partition_path(name, city, parameter, year):
+    return f"data/processed/{name}/city={quote(city, safe='')}/parameter={quote(parameter, safe='')}/year={year}"
+
+def Fingerprint_Partitions(clean_data):
+    # One hash of the cleaned measurements for each (city, parameter, year)
+    hashes = pd.util.hash_pandas_object(clean_data[['sensor_id', 'station_name', 'utc_datetime', 'value']], index=False)
+    fingerprints = hashes.groupby([clean_data['city'], clean_data['parameter'], clean_data['local_datetime'].dt.year]).sum()
+    return {f"{city}|{parameter}|{year}": format(int(h), "016x") for (city, parameter, year), h in fingerprints.items()}
+
+def processing_settings():
+    settings = {k: config[k] for k in PROCESSING_CONFIG_KEYS}
+    settings['flags'] = {k: v for k, v in config['flags'].items() if k not in CITY_FLAG_KEYS}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def Load_Manifest():
+    # Fingerprints of the last run, or None when everything has to be recomputed
+    manifest_path = Path("data/processed/manifest.json")
+    if not manifest_path.exists():
+        return None
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    if manifest.get("settings") != processing_settings():
+        print("Processing settings changed, recomputing everything")
+        return None
+    return manifest["partitions"]
+
+def Dirty_Partitions(fingerprints):
+    # Partitions to recompute, or None when everything has to be recomputed
+    previous = Load_Manifest()
+    if previous is None:
+        return None
+
+    dirty = {key for key, h in fingerprints.items() if previous.get(key) != h}
+    removed = set(previous) - set(fingerprints)
+
+    dependants = set()
+    for key in dirty:
+        city, parameter, year = key.split("|")
+        following = f"{city}|{parameter}|{int(year) + 1}"                        # Rolling 8h means (and MDA8) of next year's first day
+        if following in fingerprints:
+            dependants.add(following)
+
+    partitions = {tuple(key.split("|")) for key in dirty | dependants | removed}
+    partitions = {(city, parameter, int(year)) for city, parameter, year in partitions}
+    print(f"{len(dirty)} changed, {len(dependants - dirty)} dependant and {len(removed)} removed partitions out of {len(fingerprints)}")
+    return partitions
+
+def Select_Partitions(clean_data, partitions):
+    # Rows of the partitions to recompute plus the previous year as context for the rolling means
+    keys = pd.MultiIndex.from_arrays([clean_data['city'], clean_data['parameter'], clean_data['local_datetime'].dt.year])
+    needed = set(partitions) | {(city, parameter, year - 1) for city, parameter, year in partitions}
+    return clean_data[keys.isin(list(needed))].copy()
+
+def Save_Manifest(fingerprints):
+    manifest = {"settings": processing_settings(), "partitions": fingerprints}
+    Path("data/processed/manifest.json").write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8")
+
+def Drop_Partitions(partitions=None):
+    # Removing stored partitions from every processed table (all of them when None)
+    if not Path("data/processed").exists():
+        return
+    for table in Path("data/processed").iterdir():
+        if not table.is_dir():
+            continue
+        if partitions is None:
+            shutil.rmtree(table)
+        else:
+            for city, parameter, year in partitions:
+                shutil.rmtree(partition_path(table.name, city, parameter, year), ignore_errors=True)
+
+def Save_Clean(tables, partitions=None):
+    print("Saving clean dataframes...")
+    Path("data/processed").mkdir(parents=True, exist_ok=True)
+    for name, table in tables.items():
+        partition_cols = [c for c in ['city', 'parameter', 'year'] if c in table.columns]
+        if partitions is None:
+            shutil.rmtree(f"data/processed/{name}", ignore_errors=True)             # Rewriting the whole dataset
+        else:
+            for city, parameter, year in partitions:
+                shutil.rmtree(partition_path(name, city, parameter, year), ignore_errors=True)   # Replacing only the recomputed partitions
+            keys = pd.MultiIndex.from_arrays([table['city'], table['parameter'], table['year']])
+            table = table[keys.isin(list(partitions))]
+            if table.empty:
+                continue
+        strings = [c for c in table.columns if table[c].dtype == object and c not in partition_cols and c != 'day']
+        table.to_parquet(f"data/processed/{name}", engine="pyarrow", index=False,
+                         partition_cols=partition_cols,                             # One folder for each city, parameter (and year)
+                         compression="zstd",
+                         use_dictionary=strings,                                    # Dictionary encoding for the string columns
+                         basename_template="part-{i}.parquet")
+    print("Done!")
 
-    
+def tensor_hours():
+    # Hourly UTC axis of the analysis period, with one day of margin for the local years of any timezone
+    start = pd.Timestamp(f"{config['yearfrom']}-01-01", tz="UTC") - pd.Timedelta(days=1)
+    end = pd.Timestamp(f"{config['yearto'] + 1}-01-01", tz="UTC") + pd.Timedelta(days=1)
+    return pd.date_range(start, end, freq="h", inclusive="left")
+
+def Save_Tensor(load=Load_Clean):
+    # Dense float32 [sensor, hour] array of the clean measurements (NaN for gaps), written one city and parameter at a time
+    print("Saving sensor tensor...")
+    folder = Path("data/processed/tensor")
+    shutil.rmtree(folder, ignore_errors=True)
+    folder.mkdir(parents=True)
+
+    sensors = load("sensor_day", columns=['city', 'parameter', 'station_name', 'sensor_id']).drop_duplicates().sort_values(['city', 'parameter', 'station_name', 'sensor_id'], ignore_index=True)
+    sensors.to_parquet(folder / "sensors.parquet", index=False)                    # Row of each sensor
+    hours = tensor_hours()
+    (folder / "hours.json").write_text(json.dumps({"start": hours[0].isoformat(), "periods": len(hours)}), encoding="utf-8")
+
+    values = np.lib.format.open_memmap(folder / "values.npy", mode="w+", dtype=np.float32, shape=(len(sensors), len(hours)))
+    values[:] = np.nan
+    for (city, parameter), rows in sensors.groupby(['city', 'parameter']):
+        hourly = load("clean", columns=['station_name', 'sensor_id', 'utc_datetime', 'value'], filters=[('city', '=', city), ('parameter', '=', parameter)])
+        row = hourly[['station_name', 'sensor_id']].merge(rows[['station_name', 'sensor_id']].reset_index(names='row'), how='left')['row'].to_numpy()   # A sensor id can be listed under more than one station
+        hour = ((hourly['utc_datetime'] - hours[0]) // pd.Timedelta(hours=1)).to_numpy()
+        inside = (hour >= 0) & (hour < len(hours))
+        values[row[inside], hour[inside]] = hourly['value'].to_numpy()[inside]
+    values.flush()
     print("Done!")
-    return clean_data
 
-def Save_Clean(clean_data):
-    print("Saving clean dataframe...")
-    Path("data/processed").mkdir(parents=True, exist_ok=True)
-    clean_data.to_csv("data/processed/clean.csv", index=False)
-    print("Done!")
\ No newline at end of file
+def Load_Tensor(mmap_mode="r"):
+    # Sensor tensor, memory-mapped by default: values [sensor, hour], sensors (city, parameter, station, sensor of each row) and the hourly axis
+    folder = Path("data/processed/tensor")
+    values = np.load(folder / "values.npy", mmap_mode=mmap_mode)
+    sensors = pd.read_parquet(folder / "sensors.parquet")
+    axis = json.loads((folder / "hours.json").read_text(encoding="utf-8"))
+    return values, sensors, pd.date_range(axis["start"], periods=axis["periods"], freq="h")
+
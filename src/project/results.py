@@ -1,212 +1,147 @@
 import pandas as pd
+import numpy as np
 import seaborn as sns
+import matplotlib
+matplotlib.use("Agg")                                                             # Figures are only saved to files, also from the worker processes
 import matplotlib.pyplot as plt
+from matplotlib.colors import ListedColormap
+from matplotlib.patches import Patch
+import time
+import hashlib
+import inspect
+import json
 from pathlib import Path
 import yaml
+from .processing import Load_Clean
+from .standards import EXCEEDANCE_PERIODS, Standard_Limits, Load_Standards_Evaluation
 
 with open("config.yml", "r", encoding="utf-8") as f:
     config = yaml.safe_load(f)
 
-def CAQI(row):
-    p = row['parameter']
-    v = row['day_max_value']
-    if p == "pm10 µg/m³" or p == "pm25 µg/m³":
-        v = row['day_mean_value']
-    
-    if p not in config['CAQI_breakpoints']:
-        return None
-
-    breakpoints = config['CAQI_breakpoints'][p]
-    
-    if v == None:
-        category = None
-    elif v <= breakpoints[0]:
-        category = 1
-    elif v <= breakpoints[1]:
-        category = 2
-    elif v <= breakpoints[2]:
-        category = 3
-    elif v <= breakpoints[3]:
-        category = 4
-    elif v <= breakpoints[4]:
-        category = 5
-    else:
-        category = 6
-        
-    return category
-
-def CAQI_qualitative(category):
-    if category == 1:
-        return "Good"
-    elif category == 2:
-        return "Fair"
-    elif category == 3:
-        return "Moderate"
-    elif category == 4:
-        return "Poor"
-    elif category == 5:
-        return "Very Poor"
-    elif category == 6:
-        return "Extremely Poor"
-    else: return None
-
-
-def calculate_compliance_eu_2030_days(row, aggregation="day"):  
-    p = row['parameter']
-    if aggregation == "day":
-        v = row['day_mean_value']
-        if p == 'o3 µg/m³':
-            v = row['mda8']
-    
-    elif aggregation == "station":
-        v = row['day_mean_value_per_station']
-        if p == 'o3 µg/m³':
-            v = None
-    
-    
-    breakpoints = config['new_standards_day']
-    
-    if p not in breakpoints:
-        return None
-
-    if pd.isna(v): 
-        return None
-    
-    if v > breakpoints[p]:
-        return 1
-    
-    return 0
-
-
-
+CAQI_LABELS = ['Good', 'Fair', 'Moderate', 'Poor', 'Very Poor', 'Extremely Poor']   # CAQI categories 1 to 6
+CAQI_COLOURS = ['#79bc6a', '#bbcf4c', '#eec20b', '#f29305', '#e8416f', '#960032']   # From good to extremely poor
+CAQI_DAILY_MEAN = ['pm10 µg/m³', 'pm25 µg/m³']                                   # Classified on the daily mean, the others on the daily max
+DAILY_LIMITS = Standard_Limits('2030', EXCEEDANCE_PERIODS)                        # EU 2030 daily limits (MDA8 for O3)
+PLOT_CONFIG_KEYS = ['locations']                                                   # Settings read by the figure functions
+PLOT_MANIFEST = Path("results/plots_manifest.json")                               # Key of the last render of each figure
+
+def CAQI_Categories(caqi):
+    # Ordered labels of the CAQI categories (NaN when missing)
+    return pd.Categorical.from_codes(caqi.fillna(0).astype(int) - 1, categories=CAQI_LABELS, ordered=True)
+
+def CAQI_Table(daily_data):
+    print("Classifying CAQI...")
+    caqi = daily_data[['city', 'parameter', 'year', 'day']].copy()
+    values = np.where(daily_data['parameter'].isin(CAQI_DAILY_MEAN), daily_data['day_mean_value'], daily_data['day_max_value'])
+    categories = np.full(len(caqi), np.nan)
+    for parameter, breakpoints in config['CAQI_breakpoints'].items():
+        rows = (daily_data['parameter'] == parameter).to_numpy() & (values >= 0)             # No category for missing or negative values (below the grid)
+        categories[rows] = np.searchsorted(breakpoints, values[rows], side='left') + 1   # Category 1 up to the first breakpoint (included)
+    caqi['CAQI'] = pd.array(categories, dtype="Int64")
+    caqi['CAQI_qual'] = CAQI_Categories(caqi['CAQI'])
+    caqi['CAQI_global'] = caqi.groupby(['city', 'day'])['CAQI'].transform('max')   # Worst parameter of each city-day
+    caqi['CAQI_global_qual'] = CAQI_Categories(caqi['CAQI_global'])
+    caqi.to_parquet("data/processed/caqi_daily.parquet", index=False)             # Days, nullable categories and ordered labels kept as they are
+    return caqi
+
+def Load_CAQI():
+    return pd.read_parquet("data/processed/caqi_daily.parquet", engine="pyarrow")
+
+
+def calculate_compliance_eu_2030_days(data, value='day_mean_value', o3_value='mda8'):
+    # 1 for the days above the 2030 daily limit, 0 below it, NaN when not regulated or without a value (MDA8 for O3)
+    v = data[value].where(data['parameter'] != 'o3 µg/m³', data[o3_value]).to_numpy(dtype=float)
+    limits = data['parameter'].map(DAILY_LIMITS).to_numpy(dtype=float)
+    return pd.Series(np.where(np.isnan(v) | np.isnan(limits), np.nan, (v > limits).astype(float)), index=data.index)
+
+
+def Daily_Values(load=Load_Clean):
+    # Daily values of each city and parameter, without the yearly quality columns (all the CAQI and the standards are computed from)
+    city_day = load("city_day", columns=['city', 'parameter', 'year', 'day', 'day_of_the_week', 'season', 'active_sensors_per_day_city_parameter', 'day_mean_value', 'day_max_value', 'day_median_value', 'mda8'])
+    return city_day.sort_values(['city', 'parameter', 'day'], key=lambda c: c.map({city: i for i, city in enumerate(config['locations'])}) if c.name == 'city' else c, ignore_index=True)   # Cities in config order
+
+def Cutting_Hourly_Values(load=Load_Clean):
+    print("Preparing data...")
+    city_year = load("city_year")
+    city_weekday = load("city_weekday")
+    city_season = load("city_season")
 
+    daily_data = (Daily_Values(load)
+                  .merge(city_year, on=['city', 'parameter', 'year'], how='left')
+                  .merge(city_weekday, on=['city', 'parameter', 'day_of_the_week'], how='left')
+                  .merge(city_season, on=['city', 'parameter', 'season'], how='left'))
+    daily_data = daily_data[['parameter', 'city', 'day', 'day_of_the_week', 'season', 'year', 'active_sensors_per_day_city_parameter', 'year_median_active_sensors_per_city_parameter', 'percent_days_avaiable_per_city_year', 'flag_city_parameter', 'day_mean_value', 'day_max_value', 'mean_value_per_weekday', 'mean_value_per_season', 'mean_value_per_year', 'day_median_value', 'mda8']]
+    daily_data.to_parquet("data/processed/daily_data.parquet", index=False)       # Kept for later runs, the results of this run use the frame in memory
+    return daily_data
 
+def Load_Daily_Data():
+    return pd.read_parquet("data/processed/daily_data.parquet", engine="pyarrow")
 
-def Cutting_Hourly_Values():
-    print("Preparing data...")
-    clean_data = pd.read_csv("data/processed/clean.csv")
-    clean_data.drop(columns=['value', 'local_datetime', 'utc_datetime', 'station_name', 'sensor_id', 'day_mean_value_per_station', 'sensor_percent_coverage_per_day', 'sensors_percent_coverage_per_year', 'valid_sensor',  'utc_datetime', 'median_hourly_value',	'rolling_8h_mean', 'day_max_value_per_station', 'day_median_value_per_station', 'mean_sensor_percent_coverage_per_day'], inplace = True)
-    clean_data.drop_duplicates(keep="first", inplace = True, ignore_index=True)
-    clean_data.to_csv("data/processed/daily_data.csv", index=False)
-    return clean_data
 
+def number_or(values, mask, default):
+    # Numbers where the mask is set, the default text elsewhere (numbers are turned into text only when writing the table)
+    return [(int(v) if v == int(v) else float(v)) if m else default for v, m in zip(values, mask)]
 
 
-def Make_Compliance_Table():
+def Make_Compliance_Table(daily_data=None, evaluation=None, load=Load_Clean):
     print("Making compliance table...")
-    df = pd.read_csv("data/processed/daily_data.csv")
-    report = []  
-    stats = df.groupby(['parameter', 'city', 'year'])['day_mean_value'].mean()
-    stats = pd.DataFrame(stats)
-    
-    for row in stats.itertuples():
-        p, city, year = row.Index  # The MultiIndex tuple
-        media = stats.loc[(p, city, year), 'day_mean_value']
-        
-        res = {
-            'City' : city,
-            'Parameter': p,
-            'Year' : year,
-            'Yearly Average (µg/m³)': round(media, 2),
-            'Current yearly limit (µg/m³)': "Not regualted",
-            '2030 yearly limit (µg/m³)': "Not regulated",
-            'Compliance (Yearly Average)': "Not Applicable",
-            'Percent Above Current Standards': "Not Applicable",
-            'Percent Above 2030 Standards': "Not Applicable",
-            'Daily limit value (µg/m³)': "Not regulated",
-            'Days above limit value': "Not Applicable",
-            'Current days limit': "Not regualted",
-            '2030 days limit': "Not regulated",
-            'Compliance (Days)' : "Not Applicable"
-        }
-
-        # PM2.5, PM10, NO2
-        for key in config['current_standards_year']:
-            if p == key:
-                # Controllo Media Annua
-                
-                res['Current yearly limit (µg/m³)'] = config['current_standards_year'][key]
-                res['2030 yearly limit (µg/m³)'] = config['new_standards_year'][key]
-
-                if media > config['current_standards_year'][key]:
-                    res['Compliance (Yearly Average)'] = f"Critical (Above current limits and above 2030 limits)"
-                    res['Percent Above Current Standards'] = f"{((media / config['current_standards_year'][key]) -1) *100:.2f}% above current standards"
-                    res['Percent Above 2030 Standards'] = f"{((media / config['new_standards_year'][key]) -1) *100:.2f}% above 2030 standards"
-                
-                elif media <= config['current_standards_year'][key] and media > config['new_standards_year'][key]:
-                    res['Compliance (Yearly Average)'] = f"Problematic (Below current limit but above 2030 limit)"
-                    
-                    res['Percent Above Current Standards'] = f"Below current standards"
-                    res['Percent Above 2030 Standards'] = f"{((media / config['new_standards_year'][key]) -1) *100:.2f}% above 2030 standards"
-                
-                elif media <= config['new_standards_year'][key]:
-                    res['Compliance (Yearly Average)'] = f"Good (Below current limit and also below 2030 limit)"
-                    res['Percent Above Current Standards'] = f"Below current standards"
-                    res['Percent Above 2030 Standards'] = f"Below 2030 standards"
-                
-                # Controllo giorni di sforamento
-                if key == 'pm10 µg/m³':
-                    giorni_over_45 = len(df[(df['parameter'] == "pm10 µg/m³") & (df['year'] == year) & (df['city'] == city) &
-                                          (df['day_mean_value'] > 45)])
-                    res['Daily limit value (µg/m³)'] = 45
-                    res['Days above limit value'] = giorni_over_45
-                    res['Current days limit'] = 35
-                    res['2030 days limit'] = 18
-                    # Limite attuale 35 giorni, limite 2030 ridotto a 18 giorni
-                    if giorni_over_45 > 35: res['Compliance (Days)'] = f"Critical (Above current limits and above 2030 limits"
-                    elif giorni_over_45 > 18 and giorni_over_45 <= 35: res['Compliance (Days)'] = f"Problematic (Below current limit but above 2030 limit"
-                    elif giorni_over_45 <= 18: res['Compliance (Days)'] = f"Good (Below current limit and also below 2030 limit"
-
-                if key == 'pm25 µg/m³':
-                    giorni_over_25 = len(df[(df['parameter'] == "pm25 µg/m³") & (df['year'] == year) & (df['city'] == city) &
-                                          (df['day_mean_value'] > 25)])
-                    res['Daily limit value (µg/m³)'] = 25
-                    res['Days above limit value'] = giorni_over_25
-                    
-                    res['2030 days limit'] = 18
-                    # Introdotto limite 2030 a 18 giorni
-                    if giorni_over_25 > 18: res['Compliance (Days)'] = f"Problematic (Above 2030 limit)"
-                    elif giorni_over_25 <= 18: res['Compliance (Days)'] = f"Good (Below 2030 limit)"
-                
-                if key == 'no2 µg/m³':
-                    giorni_over_50 = len(df[(df['parameter'] == "no2 µg/m³") & (df['year'] == year) & (df['city'] == city) &
-                                          (df['day_mean_value'] > 50)])
-                    res['Daily limit value (µg/m³)'] = 50
-                    res['Days above limit value'] = giorni_over_50
-                    
-                    res['2030 days limit'] = 18
-                    # Introdotto limite 2030 a 18 giorni
-                    if giorni_over_50 > 18: res['Compliance (Days)'] = f"Problematic (Above 2030 limit)"
-                    elif giorni_over_50 <= 18: res['Compliance (Days)'] = f"Good (Below 2030 limit)"
-
-        # Logica speciale per Ozono (O3)
-        if p == 'o3 µg/m³':
-            res['Daily limit value (µg/m³)'] = 120
-            res['Current days limit'] = 25
-            res['2030 days limit'] = 18
-            if year >= config['yearfrom'] + 2:
-                years_range = [year, year - 1, year - 2]
-                years_avaiable = df[(df['parameter'] == "o3 µg/m³") & 
-                       (df['year'].isin(years_range)) & 
-                       (df['city'] == city)]['year'].unique()
-                
-                if len(years_avaiable) == 3:
-
-                    # Sforamenti della soglia 120 µg/m³ (media su tre anni)
-                    giorni_over_120 = len(df[(df['parameter'] == "o3 µg/m³") & (df['year'].isin(years_range)) & (df['city'] == city) &
-                                                (df['mda8'] > 120)]) / 3
-                    giorni_over_120 = round(giorni_over_120, 1)
-                    res['Days above limit value'] = giorni_over_120
-                    # Attualmente: max 25 giorni/anno. 2030: l'obiettivo è ridurre a 18 o meno.
-                    if giorni_over_120 > 25: res['Compliance (Days)'] = f"Critical (Above current limits and above 2030 limits"
-                    elif giorni_over_120 > 18 and giorni_over_120 <= 25: res['Compliance (Days)'] = f"Problematic (Below current limit but above 2030 limit"
-                    elif giorni_over_120 <= 18: res['Compliance (Days)'] = f"Good (Below current limit and also below 2030 limit"
-
-            
-        report.append(res)
-    
-    report = pd.DataFrame(report)
-    flags = pd.read_csv("results/quality_checks/cities_quality.csv")
+    df = Load_Daily_Data() if daily_data is None else daily_data
+    keys = ['parameter', 'city', 'year']
+    stats = df.groupby(keys)['day_mean_value'].mean().rename('media').reset_index()
+    evaluation = Load_Standards_Evaluation() if evaluation is None else evaluation
+
+    def pick(standard_set, periods, column):
+        # One value of the evaluation of a set of standards for each row of the table (NaN when not regulated)
+        chosen = evaluation[(evaluation['set'] == standard_set) & evaluation['period'].isin(periods)].set_index(keys)[column]
+        return chosen.reindex(pd.MultiIndex.from_frame(stats[keys])).to_numpy(dtype=float)
+
+    media = stats['media'].to_numpy()
+    current_year = pick('current', ['annual'], 'limit')
+    new_year = pick('2030', ['annual'], 'limit')
+    yearly = ~np.isnan(current_year)
+    above_current = media > current_year
+    above_new = media > new_year
+    year_compliance = np.select(
+        [yearly & above_current, yearly & ~above_current & above_new, yearly & (media <= new_year)],
+        ["Critical (Above current limits and above 2030 limits)", "Problematic (Below current limit but above 2030 limit)", "Good (Below current limit and also below 2030 limit)"],
+        "Not Applicable")
+    assessed_year = year_compliance != "Not Applicable"
+
+    # Days above the 2030 daily limit, against the exceedances allowed now and from 2030
+    daily_limit = pick('2030', EXCEEDANCE_PERIODS, 'limit')
+    exceedance_days = pick('2030', EXCEEDANCE_PERIODS, 'value')
+    window = pick('2030', EXCEEDANCE_PERIODS, 'years')
+    current_limit = pick('current', EXCEEDANCE_PERIODS, 'allowed')
+    new_limit = pick('2030', EXCEEDANCE_PERIODS, 'allowed')
+    daily_rows = ~np.isnan(daily_limit)
+    counted = ~np.isnan(exceedance_days)
+    has_current = ~np.isnan(current_limit)
+    days_compliance = np.select(
+        [counted & has_current & (exceedance_days > current_limit), counted & has_current & (exceedance_days > new_limit), counted & has_current,
+         counted & (exceedance_days > new_limit), counted],
+        ["Critical (Above current limits and above 2030 limits", "Problematic (Below current limit but above 2030 limit", "Good (Below current limit and also below 2030 limit",
+         "Problematic (Above 2030 limit)", "Good (Below 2030 limit)"],
+        "Not Applicable")
+
+    report = pd.DataFrame({
+        'City': stats['city'],
+        'Parameter': stats['parameter'],
+        'Year': stats['year'],
+        'Yearly Average (µg/m³)': [round(v, 2) for v in media],
+        'Current yearly limit (µg/m³)': number_or(current_year, yearly, "Not regualted"),
+        '2030 yearly limit (µg/m³)': number_or(new_year, yearly, "Not regulated"),
+        'Compliance (Yearly Average)': year_compliance,
+        'Percent Above Current Standards': np.where(above_current, [f"{((m / c) - 1) * 100:.2f}% above current standards" for m, c in zip(media, current_year)],
+                                                    np.where(assessed_year, "Below current standards", "Not Applicable")),
+        'Percent Above 2030 Standards': np.where((above_current | above_new) & assessed_year, [f"{((m / n) - 1) * 100:.2f}% above 2030 standards" for m, n in zip(media, new_year)],
+                                                 np.where(assessed_year, "Below 2030 standards", "Not Applicable")),
+        'Daily limit value (µg/m³)': number_or(daily_limit, daily_rows, "Not regulated"),
+        'Days above limit value': [(round(float(d), 1) if w > 1 else int(d)) if c else "Not Applicable" for d, w, c in zip(exceedance_days, window, counted)],   # Averaged over the years of the window
+        'Current days limit': number_or(current_limit, daily_rows & has_current, "Not regualted"),
+        '2030 days limit': number_or(new_limit, daily_rows, "Not regulated"),
+        'Compliance (Days)': days_compliance,
+    })
+    flags = load("city_year", columns=['city', 'year', 'parameter', 'year_median_active_sensors_per_city_parameter', 'percent_days_avaiable_per_city_year', 'flag_city_parameter'])   # Same as cities_quality.csv
     flags = flags.rename(columns= {'city' : 'City', 'year' : 'Year', 'parameter' : 'Parameter', 'flag_city_parameter' : 'Flag', 'year_median_active_sensors_per_city_parameter' : 'Median active sensors', 'percent_days_avaiable_per_city_year' : 'Percent days avaiable'})
     flags = flags[['City', 'Year', 'Parameter', 'Flag', 'Median active sensors', 'Percent days avaiable']]    
     report = report.merge(flags, on=['City', 'Year', 'Parameter'], how='left')
@@ -215,14 +150,57 @@ def Make_Compliance_Table():
     print("Done!")
 
 
-def Make_Plots():
-    print("Making Plots...")
-    df = pd.read_csv("data/processed/daily_data.csv")
-    Path("results/plots/main").mkdir(parents=True, exist_ok=True)
-    
-    # BOXPLOT
+def Render(figure, path, *args):
+    # Drawing one figure from its slice of data and saving it, returning how long it took
+    start = time.perf_counter()
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    g = figure(*args)
+    g.figure.savefig(path, bbox_inches='tight')
+    plt.close(g.figure)
+    return path, time.perf_counter() - start
+
+def plot_key(job):
+    # Hash of everything a figure depends on: its data and arguments, the code of its figure function (with the constants it reads), its settings and the plotting libraries
+    _, figure, path, *args = job
+    constants = {name: figure.__globals__[name] for name in figure.__code__.co_names if name != 'config' and isinstance(figure.__globals__.get(name), (list, dict, str, int, float))}
+    digest = hashlib.sha256(json.dumps([path, inspect.getsource(figure), inspect.getsource(Render), constants, {k: config[k] for k in PLOT_CONFIG_KEYS},
+                                        sns.__version__, matplotlib.__version__], default=str).encode())
+    for arg in args:
+        if isinstance(arg, pd.DataFrame):
+            digest.update(json.dumps([list(arg.columns), [str(t) for t in arg.dtypes]]).encode())
+            digest.update(pd.util.hash_pandas_object(arg, index=False).to_numpy().tobytes())   # Row order included, as it sets the order of the categories
+        else:
+            digest.update(repr(arg).encode())
+    return digest.hexdigest()
+
+def Load_Plot_Manifest():
+    return json.loads(PLOT_MANIFEST.read_text(encoding="utf-8")) if PLOT_MANIFEST.exists() else {}
+
+def Stale_Plots(jobs):
+    # Jobs whose figure is missing or was rendered from different inputs, and the key of every figure
+    keys = {job[2]: plot_key(job) for job in jobs}
+    if not config["pipeline"]["plot_cache"]:
+        return jobs, keys
+    manifest = Load_Plot_Manifest()
+    stale = [job for job in jobs if manifest.get(job[2]) != keys[job[2]] or not Path(job[2]).exists()]
+    print(f"{len(jobs) - len(stale)} of {len(jobs)} figures unchanged, not rendered again")
+    return stale, keys
+
+def Save_Plot_Manifest(keys):
+    manifest = Load_Plot_Manifest()
+    manifest.update(keys)
+    PLOT_MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+    PLOT_MANIFEST.write_text(json.dumps(manifest, indent=2, ensure_ascii=False, sort_keys=True), encoding="utf-8")
+
+def Report_Timings(timings):
+    for path, seconds in sorted(timings, key=lambda timing: -timing[1]):
+        print(f"{seconds:8.2f}s  {path}")
+    print(f"{sum(seconds for _, seconds in timings):8.2f}s  total ({len(timings)} figures)")
+
+
+def boxplot_figure(data):
     g = sns.catplot (
-        data=df, 
+        data=data, 
         x = "city", 
         y = "day_mean_value", 
         hue = "city", 
@@ -235,137 +213,83 @@ def Make_Plots():
     g.set_axis_labels("City", "Daily mean Value (µg/m³)")
     g.figure.suptitle("Dispersion of daily measures", y=1.10, fontsize=18)
     g.figure.text(0.5, 1.03, "Dispersion of daily mean value for each city and parameter", ha='center', va='center', fontsize=12, style='italic')
-
-    g.figure.savefig("results/plots/main/daily_averages_boxplot.png", bbox_inches='tight')
-    plt.close(g.figure)
-    print("Plot 1 done!")
-
-    # DENSITY PLOTS
-    Path("results/plots/density_plots").mkdir(parents=True, exist_ok=True)
-
-    for parameter in config['parameters']:
-        p = parameter.replace(" µg/m³", "")
-        temp_df = df[df['parameter'] == parameter]
-
-        g = sns.displot(
-            data=temp_df, 
-            x='day_mean_value', 
-            hue='city',  
-            kde=True, 
-            stat="density", 
-            common_norm=False,
-            palette="Set1")
-        
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Dalily mean Value (µg/m³)")
-        g.figure.suptitle(f"Distribution of daily measures for {p}", y=1.10, fontsize=18)
-        g.figure.text(0.5, 1.03, "Mean value density plot", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("City")
-        g.figure.savefig(f"results/plots/density_plots/daily_averages_densityplot_{p}.png", bbox_inches='tight')
-        plt.close(g.figure)
-    
-    print("Plot 2 done!")
+    return g
+
+def density_figure(data, p):
+    g = sns.displot(
+        data=data, 
+        x='day_mean_value', 
+        hue='city',  
+        kde=True, 
+        stat="density", 
+        common_norm=False,
+        palette="Set1")
     
-    # SEASONAL TRENDS
-    Path("results/plots/seasonal_trends").mkdir(parents=True, exist_ok=True)
-
-    for parameter in config['parameters']:
-        temp_df = df[df['parameter'] == parameter]  
-        
-        p = parameter.replace(" µg/m³", "") 
-        g = sns.catplot(
-            data=temp_df, 
-            x="season", 
-            y="mean_value_per_season", 
-            col="city",
-            col_order=config['locations'],
-            hue="city",
-            col_wrap=3, 
-            kind="bar", 
-            palette="Dark2",
-            order=['winter', 'spring', 'summer', 'fall'])
-        
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Days", "Mean Value (µg/m³)")
-        g.figure.suptitle(f"Seasonal trends for {p}", y=1.05, fontsize=18)
-        g.figure.text(0.5, 1.01, "Mean value for each season, city and parameter", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("City")
-        g.figure.savefig(f"results/plots/seasonal_trends/seasonal_trends_{p}.png", bbox_inches='tight')
-        plt.close(g.figure)
-
-    print("Plot 3 done!")
-
-    # CAQI per parameter 
-    Path("results/plots/CAQI").mkdir(parents=True, exist_ok=True)
-    df['CAQI'] = df[['parameter', 'day_mean_value', 'day_max_value']].apply(CAQI, axis=1)
-    df['CAQI_qual'] = df['CAQI'].apply(CAQI_qualitative)
-
-    for parameter in config['parameters']:
-        temp_df = df[df['parameter'] == parameter]
-        v = 'day_max_value'
-        V = "Max daily value"  
-        
-        p = parameter.replace(" µg/m³", "")
-        if parameter == "pm10 µg/m³" or parameter == "pm25 µg/m³":
-            v = 'day_mean_value'
-            V = "Mean daily value"
-        g = sns.catplot(
-            data=temp_df, 
-            x ="day", 
-            y=v, 
-            hue="CAQI_qual", 
-            col="city",            
-            col_order=config['locations'],
-            col_wrap=3,
-            kind="bar", 
-            errorbar=None, 
-            hue_order=['Good', 'Fair', 'Moderate', 'Poor', 'Very Poor', 'Extremely Poor'])
-        
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Days", V)
-        g.figure.suptitle("CAQI (per parameter)", y=1.05, fontsize=18)
-        g.figure.text(0.5, 1.01, f"CAQI for {p}", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("CAQI")
-        g.set_xticklabels([])
-        g.tick_params(bottom=False) #delete the text on the x-axis because ilegbiles
-        
-        g.figure.savefig(f"results/plots/CAQI/CAQI_per_parameter/CAQI_{p}.png", bbox_inches='tight')
-        plt.close(g.figure)
-    print("Plot 4 done!")
-
-    # CAQI Global
-    df['CAQI_global'] = df.groupby(['city', 'day'])['CAQI'].transform('max')
-    df['CAQI_global_qual'] = df['CAQI_global'].apply(CAQI_qualitative)
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Dalily mean Value (µg/m³)")
+    g.figure.suptitle(f"Distribution of daily measures for {p}", y=1.10, fontsize=18)
+    g.figure.text(0.5, 1.03, "Mean value density plot", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("City")
+    return g
 
+def seasonal_figure(data, p):
     g = sns.catplot(
-        data=df, 
-        x ="day", 
-        y="day_median_value", 
-        hue="CAQI_global_qual", 
+        data=data, 
+        x="season", 
+        y="mean_value_per_season", 
         col="city",
         col_order=config['locations'],
+        hue="city",
         col_wrap=3, 
         kind="bar", 
-        errorbar=None, 
-        hue_order=['Good', 'Fair', 'Moderate', 'Poor', 'Very Poor', 'Extremely Poor'])
+        palette="Dark2",
+        order=['winter', 'spring', 'summer', 'fall'])
     
     g.set_titles(col_template="{col_name}")
-    g.set_axis_labels("Days", "Median Value (µg/m³)")
-    g.figure.suptitle("Daily CAQI (global)", y=1.10, fontsize=18)
-    g.figure.text(0.5, 1.03, "Median value and global CAQI for each day, city", ha='center', va='center', fontsize=12, style='italic')
-    g._legend.set_title("CAQI")
-    g.set_xticklabels([])
-    g.tick_params(bottom=False) #delete the text on the x-axis because ilegbiles
-    
-    g.figure.savefig("results/plots/CAQI/CAQI_global.png", bbox_inches='tight')
-    plt.close(g.figure)
-    print("Plot 5 done!")
-
-    df['count_days_for_CAQI'] = df.groupby(['CAQI_global_qual', 'city'])['day'].transform('nunique')
-
-    # CAQI count
+    g.set_axis_labels("Days", "Mean Value (µg/m³)")
+    g.figure.suptitle(f"Seasonal trends for {p}", y=1.05, fontsize=18)
+    g.figure.text(0.5, 1.01, "Mean value for each season, city and parameter", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("City")
+    return g
+
+def caqi_calendar_figure(data, title, subtitle):
+    # One image per city: a row for each year and a column for each day of the year, coloured by the CAQI category of the day
+    if data.empty:
+        fig, ax = plt.subplots(figsize=(6, 2))
+        ax.set_axis_off()
+        ax.text(0.5, 0.5, "No CAQI data", ha='center', va='center')
+        fig.suptitle(title, fontsize=18)
+        return fig
+    cities = [city for city in config['locations'] if city in set(data['city'])]
+    days = pd.to_datetime(data['day'])
+    years = np.arange(days.dt.year.min(), days.dt.year.max() + 1)
+    columns_of_days = days.dt.dayofyear - 1 + (~days.dt.is_leap_year & (days.dt.month > 2))   # Columns of a leap year, so that each (month, day) has the same column every year
+    grid = np.full((len(cities), len(years), 366), np.nan)
+    grid[data['city'].map({city: i for i, city in enumerate(cities)}).to_numpy(), (days.dt.year - years[0]).to_numpy(), columns_of_days.to_numpy()] = data['CAQI'].to_numpy(dtype=float, na_value=np.nan)
+
+    columns = min(3, len(cities))
+    rows = -(-len(cities) // columns)
+    fig, axes = plt.subplots(rows, columns, figsize=(6 * columns, (0.35 * len(years) + 1.2) * rows), squeeze=False, sharex=True)
+    colours = ListedColormap(CAQI_COLOURS)
+    colours.set_bad("whitesmoke")                                                  # Days without a category
+    for ax, city, image in zip(axes.flat, cities, grid):
+        ax.imshow(image, cmap=colours, vmin=0.5, vmax=len(CAQI_COLOURS) + 0.5, aspect="auto", interpolation="nearest")
+        ax.set_title(city)
+        ax.set_yticks(range(len(years)), years)
+        ax.set_xticks(pd.date_range("2000-01-01", periods=12, freq="MS").dayofyear - 1, ["J", "F", "M", "A", "M", "J", "J", "A", "S", "O", "N", "D"])
+    for ax in axes.flat[len(cities):]:
+        ax.set_visible(False)
+
+    fig.legend(handles=[Patch(color=colour, label=label) for colour, label in zip(CAQI_COLOURS, CAQI_LABELS)], title="CAQI", loc="center left", bbox_to_anchor=(1, 0.5), frameon=False)
+    fig.tight_layout()
+    height = fig.get_figheight()                                                   # Titles placed in inches above the grid, whatever the number of years
+    fig.suptitle(title, y=1 + 0.6 / height, fontsize=18)
+    fig.text(0.5, 1 + 0.2 / height, subtitle, ha='center', va='center', fontsize=12, style='italic')
+    return fig
+
+def caqi_count_figure(data):
     g = sns.catplot(
-        data=df, 
+        data=data, 
         x="CAQI_global_qual", 
         y="count_days_for_CAQI", 
         col="city", 
@@ -373,217 +297,269 @@ def Make_Plots():
         col_wrap=3, 
         hue="CAQI_global_qual", 
         kind="bar", 
-        order=['Good', 'Fair', 'Moderate', 'Poor', 'Very Poor', 'Extremely Poor'],
-        hue_order=['Good', 'Fair', 'Moderate', 'Poor', 'Very Poor', 'Extremely Poor'])
+        order=CAQI_LABELS,
+        hue_order=CAQI_LABELS)
     
     g.set_titles(col_template="{col_name}")
     g.set_axis_labels("CAQI", "Days)")
     g.figure.suptitle("CAQI (global) Frequency", y=1.10, fontsize=18)
     g.figure.text(0.5, 1.03, "Frequency for each CAQI category per city", ha='center', va='center', fontsize=12, style='italic')
     g.set_xticklabels(rotation=45)
+    return g
+
+def annual_trend_figure(data, p, limit):
+    g = sns.catplot(
+    data=data, 
+    x="year", 
+    y="day_mean_value", 
+    col="city",
+    col_order=config['locations'],
+    hue="flag_city_parameter",
+    col_wrap=3,
+    kind="bar", 
+    palette="Blues",
+    hue_order=['Very Low', 'Low', 'Medium', 'High'],
+    edgecolor="black")
+    for ax in g.axes.flat:
+        ax.axhline(limit, color='black', linestyle='--', linewidth=1.5, zorder=2)
+            
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Year", "Mean Value (µg/m³)")
+    g.figure.suptitle(f"Annual trend for {p}", y=1.05, fontsize=18)  
+    g.figure.text(0.5, 1.01, f"Mean annual value for each year and city", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("Quality Flag")
+    return g
+
+def compliance_days_figure(data, p):
+    g = sns.catplot(
+        data=data, 
+        x="year", 
+        y="compliance_ue_2030_days", 
+        hue="flag_city_parameter", 
+        col="city",
+        col_order=config['locations'],
+        col_wrap=3, 
+        kind="bar",
+        palette="Blues",
+        hue_order=['Very Low', 'Low', 'Medium', 'High'],
+        edgecolor="black")
+    
+    for ax in g.axes.flat:
+            ax.axhline(18, color='black', linestyle='--', linewidth=1.5, zorder=2)
+    
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Year", "Days")
+    g.figure.suptitle(f"{p} Compliance with EU 2030's rule (daily maximums)", y=1.05, fontsize=18)
+    g.figure.text(0.5, 1.01, "Days above the limit for each city and year", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("Quality Flag")
+    return g
 
-    g.figure.savefig("results/plots/CAQI/count_CAQI.png", bbox_inches='tight')
-    plt.close(g.figure)
-    print("Plot 6 done!")
 
+def Plot_Jobs(daily_data=None):
+    # One (Render, figure, path, data) task for each figure of the main results, with only the rows and columns it draws
+    df = Load_Daily_Data() if daily_data is None else daily_data
+    jobs = [(Render, boxplot_figure, "results/plots/main/daily_averages_boxplot.png", df[['city', 'parameter', 'day_mean_value']])]
 
+    for parameter in config['parameters']:
+        p = parameter.replace(" µg/m³", "")
+        temp_df = df[df['parameter'] == parameter]
+        jobs.append((Render, density_figure, f"results/plots/density_plots/daily_averages_densityplot_{p}.png", temp_df[['city', 'day_mean_value']], p))
+        jobs.append((Render, seasonal_figure, f"results/plots/seasonal_trends/seasonal_trends_{p}.png", temp_df[['city', 'season', 'mean_value_per_season']].drop_duplicates(), p))   # One value per city and season
 
     # ANNUAL MEAN
-    
+    annual_limits = Standard_Limits('2030', ['annual'])
     for parameter in config['parameters']:
         if parameter != "o3 µg/m³":
-            temp_df = df[df['parameter'] == parameter]
-                    
             p = parameter.replace(" µg/m³", "")
-            g = sns.catplot(
-            data=temp_df, 
-            x="year", 
-            y="day_mean_value", 
-            col="city",
-            col_order=config['locations'],
-            hue="flag_city_parameter",
-            col_wrap=3,
-            kind="bar", 
-            palette="Blues",
-            hue_order=['Very Low', 'Low', 'Medium', 'High'],
-            edgecolor="black")
-            for ax in g.axes.flat:
-                ax.axhline(config['new_standards_year'][parameter], color='black', linestyle='--', linewidth=1.5, zorder=2)
-                    
-            g.set_titles(col_template="{col_name}")
-            g.set_axis_labels("Year", "Mean Value (µg/m³)")
-            g.figure.suptitle(f"Annual trend for {p}", y=1.05, fontsize=18)  
-            g.figure.text(0.5, 1.01, f"Mean annual value for each year and city", ha='center', va='center', fontsize=12, style='italic')
-            g._legend.set_title("Quality Flag")
-                    
-            g.figure.savefig(f"results/plots/main/trends_annual_{p}.png", bbox_inches='tight')
-            plt.close(g.figure)
-
-    print("Plot 7 done!")
-    
+            temp_df = df[df['parameter'] == parameter]
+            jobs.append((Render, annual_trend_figure, f"results/plots/main/trends_annual_{p}.png", temp_df[['city', 'year', 'flag_city_parameter', 'day_mean_value']], p, annual_limits[parameter]))
+
     # COMPLIANCE DAYS
-    df['compliance_ue_2030_days'] = df[['parameter', 'day_mean_value', 'day_max_value' ,'mda8']].apply(calculate_compliance_eu_2030_days, axis=1)
-    #df['count_days_for_ue_2030'] = df.groupby(['year', 'city', 'parameter'])['compliance_ue_2030_days'].transform('sum')
+    df = df.assign(compliance_ue_2030_days=calculate_compliance_eu_2030_days(df))
     for parameter in config['parameters']:
-        temp_df = df[df['parameter'] == parameter].groupby(['year', 'city', 'flag_city_parameter'])['compliance_ue_2030_days'].sum().reset_index()
-        
         p = parameter.replace(" µg/m³", "")
-        g = sns.catplot(
-            data=temp_df, 
-            x="year", 
-            y="compliance_ue_2030_days", 
-            hue="flag_city_parameter", 
-            col="city",
-            col_order=config['locations'],
-            col_wrap=3, 
-            kind="bar",
-            palette="Blues",
-            hue_order=['Very Low', 'Low', 'Medium', 'High'],
-            edgecolor="black")
-        
-        for ax in g.axes.flat:
-                ax.axhline(18, color='black', linestyle='--', linewidth=1.5, zorder=2)
-        
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Year", "Days")
-        g.figure.suptitle(f"{p} Compliance with EU 2030's rule (daily maximums)", y=1.05, fontsize=18)
-        g.figure.text(0.5, 1.01, "Days above the limit for each city and year", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("Quality Flag")
-        g.figure.savefig(f"results/plots/main/compliance_days_2030_{p}.png", bbox_inches='tight')
-        plt.close(g.figure)
-    print("Plot 8 done!") 
-
-
-
-def Quality_Plots_deepdive():
-    print("Creating quality checks figures...")
-
-    clean_data = pd.read_csv("data/processed/clean.csv")
-    # QUALITY DEEPDIVE
-    Path("results/quality_checks/deepdive").mkdir(parents=True, exist_ok=True)
-    
-    for city in config['quality_deep_locations']:
-        data = clean_data[clean_data['city'] == city]
-        g = sns.displot(                                                                                            # Plotting sensors percent coverage per year
-        data = data,
-        x = "sensor_percent_coverage_per_day",
-        col = "parameter",
-        row="year",
-        hue = "station_name",
-        kind="ecdf",
-        palette="Set1" 
-                )
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Daily Coverage (%)", "Density")
-        g.figure.suptitle(f"{city}'s sensor quality: daily coverage", y=1.05, fontsize=20)
-        g.figure.text(0.5, 1.03, "ECDF of daily percent coverage for each sensor and parameter", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("Station Name")
-        g.figure.savefig(f"results/quality_checks/deepdive/{city}_sensor_percent_coverage_per_day.png", bbox_inches='tight')
-        plt.close(g.figure)
-
-    print("1/4")
-
-    for city in config['quality_deep_locations']:
-        data = clean_data[clean_data['city'] == city]
-        g = sns.catplot(                                                                                            # Plotting sensors percent coverage per year
-        data = data, 
-        x = "year", 
-        y = "sensors_percent_coverage_per_year",
-        col = "parameter",
-        hue = "station_name", 
-        kind = "bar",
-        palette="Set1" 
-        )
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Year", "Days Avaiable (%)")
-        g.figure.suptitle(f"{city}'s sensors' quality: days avaiable", y=1.10, fontsize=18)
-        g.figure.text(0.5, 1.03, "Percent days avaiable for each year, city, parameter and sensor", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("Station Name")
-        g.figure.savefig(f"results/quality_checks/deepdive/{city}_sensors_percent_coverage_per_year.png", bbox_inches='tight')
-        plt.close(g.figure)
-
-    print("2/4")
-    
-
-    for city in config['quality_deep_locations']:
-        data = clean_data[clean_data['city'] == city]
-        g = sns.relplot(                                                                                            # Plottinge active sensors per day
-        data = data, 
-        x = "day", 
-        y = "active_sensors_per_day_city_parameter",
-        col = "parameter",
-        hue = "parameter",
-        kind = "line",
-        palette="Dark2",
-        hue_order=["no2 µg/m³", "o3 µg/m³", "pm10 µg/m³", "pm25 µg/m³"]  
-        )
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Day", "Active Sensors")   
-        g.figure.suptitle(f"{city}'s active sensors", y=1.10, fontsize=18)
-        g.figure.text(0.5, 1.03, "Active sensors per parameter", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("Parameter")
-        g.set_xticklabels([])
-        g.tick_params(bottom=False)
-        g.figure.savefig(f"results/quality_checks/deepdive/{city}_active_sensors_per_day.png", bbox_inches='tight')
-        plt.close(g.figure)
-    print("3/4")
-
-    for city in config['quality_deep_locations']:
-        data = clean_data[clean_data['city'] == city]
-        g = sns.catplot(                                                                                            # Plotting city percent days avaiable per year
-        data = data, 
-        x = "year", 
-        y = "percent_days_avaiable_per_city_year",
-        col = "parameter",
-        hue = "parameter", 
-        kind = "bar",
-        palette="Dark2",
-        hue_order=["no2 µg/m³", "o3 µg/m³", "pm10 µg/m³", "pm25 µg/m³"] 
-        )
-        g.set_titles(col_template="{col_name}")
-        g.set_axis_labels("Year", "Days Avaiable (%)")
-        g.figure.suptitle(f"{city}'s days avaiable", y=1.10, fontsize=18)
-        g.figure.text(0.5, 1.03, "Percent days avaiable per parameter", ha='center', va='center', fontsize=12, style='italic')
-        g._legend.set_title("Parameter")
-        g.figure.savefig(f"results/quality_checks/deepdive/{city}_percent_days_avaiable_per_year.png", bbox_inches='tight')
-        plt.close(g.figure)
-    print("4/4")
-
-    
-    
-    
-def Deep_Dive_table():
-
-    clean_data = pd.read_csv("data/processed/clean.csv")
+        temp_df = df[df['parameter'] == parameter].groupby(['year', 'city', 'flag_city_parameter'])['compliance_ue_2030_days'].sum().reset_index()
+        jobs.append((Render, compliance_days_figure, f"results/plots/main/compliance_days_2030_{p}.png", temp_df, p))
+    return jobs
 
+def CAQI_Plot_Jobs(caqi=None):
+    # One (Render, figure, path, data) task for each CAQI figure
+    caqi = Load_CAQI() if caqi is None else caqi
+    jobs = []
+    for parameter in config['parameters']:
+        p = parameter.replace(" µg/m³", "")
+        jobs.append((Render, caqi_calendar_figure, f"results/plots/CAQI/CAQI_per_parameter/CAQI_{p}.png", caqi.loc[caqi['parameter'] == parameter, ['city', 'day', 'CAQI']],
+                     "CAQI (per parameter)", f"Daily CAQI for {p}"))
+    city_days = caqi[['city', 'day', 'CAQI_global']].drop_duplicates().rename(columns={'CAQI_global': 'CAQI'})   # One global category per city-day
+    jobs.append((Render, caqi_calendar_figure, "results/plots/CAQI/CAQI_global.png", city_days, "Daily CAQI (global)", "Worst CAQI category across parameters for each day, city"))
+    counts = caqi.assign(count_days_for_CAQI=caqi.groupby(['CAQI_global_qual', 'city'], observed=True)['day'].transform('nunique'))
+    jobs.append((Render, caqi_count_figure, "results/plots/CAQI/count_CAQI.png", counts[['city', 'CAQI_global_qual', 'count_days_for_CAQI']].drop_duplicates()))
+    return jobs
+
+def coverage_day_figure(data, city):
+    g = sns.displot(                                                                                            # Plotting sensors percent coverage per year
+    data = data,
+    x = "sensor_percent_coverage_per_day",
+    col = "parameter",
+    row="year",
+    hue = "station_name",
+    weights = "n_hours",                                                                                        # Hourly rows with this coverage
+    kind="ecdf",
+    palette="Set1" 
+            )
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Daily Coverage (%)", "Density")
+    g.figure.suptitle(f"{city}'s sensor quality: daily coverage", y=1.05, fontsize=20)
+    g.figure.text(0.5, 1.03, "ECDF of daily percent coverage for each sensor and parameter", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("Station Name")
+    return g
+
+def coverage_year_figure(data, city):
+    g = sns.catplot(                                                                                            # Plotting sensors percent coverage per year
+    data = data, 
+    x = "year", 
+    y = "sensors_percent_coverage_per_year",
+    col = "parameter",
+    hue = "station_name", 
+    weights = "n_hours",                                                                                        # Hourly rows of each sensor-year
+    kind = "bar",
+    palette="Set1" 
+    )
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Year", "Days Avaiable (%)")
+    g.figure.suptitle(f"{city}'s sensors' quality: days avaiable", y=1.10, fontsize=18)
+    g.figure.text(0.5, 1.03, "Percent days avaiable for each year, city, parameter and sensor", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("Station Name")
+    return g
+
+def active_sensors_figure(data, city):
+    g = sns.relplot(                                                                                            # Plottinge active sensors per day
+    data = data, 
+    x = "day", 
+    y = "active_sensors_per_day_city_parameter",
+    col = "parameter",
+    hue = "parameter",
+    kind = "line",
+    palette="Dark2",
+    hue_order=["no2 µg/m³", "o3 µg/m³", "pm10 µg/m³", "pm25 µg/m³"]  
+    )
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Day", "Active Sensors")   
+    g.figure.suptitle(f"{city}'s active sensors", y=1.10, fontsize=18)
+    g.figure.text(0.5, 1.03, "Active sensors per parameter", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("Parameter")
+    g.set_xticklabels([])
+    g.tick_params(bottom=False)
+    return g
+
+def days_available_figure(data, city):
+    g = sns.catplot(                                                                                            # Plotting city percent days avaiable per year
+    data = data, 
+    x = "year", 
+    y = "percent_days_avaiable_per_city_year",
+    col = "parameter",
+    hue = "parameter", 
+    kind = "bar",
+    palette="Dark2",
+    hue_order=["no2 µg/m³", "o3 µg/m³", "pm10 µg/m³", "pm25 µg/m³"] 
+    )
+    g.set_titles(col_template="{col_name}")
+    g.set_axis_labels("Year", "Days Avaiable (%)")
+    g.figure.suptitle(f"{city}'s days avaiable", y=1.10, fontsize=18)
+    g.figure.text(0.5, 1.03, "Percent days avaiable per parameter", ha='center', va='center', fontsize=12, style='italic')
+    g._legend.set_title("Parameter")
+    return g
+
+
+def Deepdive_Plot_Jobs(cities=config['quality_deep_locations'], load=Load_Clean):
+    # One (Render, figure, path, data, city) task for each quality figure of the deep dive cities, from the daily and yearly summaries
+    only_cities = [('city', 'in', cities)]
+    sensor_keys = ['city', 'parameter', 'station_name', 'sensor_id', 'year']
+    sensor_day = load("sensor_day", columns=sensor_keys + ['n_hours', 'sensor_percent_coverage_per_day'], filters=only_cities)
+    sensor_year = load("sensor_year", columns=sensor_keys + ['sensors_percent_coverage_per_year'], filters=only_cities)
+    city_day = load("city_day", columns=['city', 'parameter', 'day', 'active_sensors_per_day_city_parameter'], filters=only_cities)
+    city_year = load("city_year", columns=['city', 'parameter', 'year', 'percent_days_avaiable_per_city_year'], filters=only_cities)
+
+    # Values repeated on every hourly row are drawn once, weighted by their hourly rows where the figure counts them
+    daily_coverage = sensor_day.groupby(['city', 'year', 'parameter', 'station_name', 'sensor_percent_coverage_per_day'], sort=False)['n_hours'].sum().reset_index()
+    yearly_coverage = sensor_year.merge(sensor_day.groupby(sensor_keys, sort=False)['n_hours'].sum().reset_index(), on=sensor_keys)
+    jobs = []
+    for city in cities:
+        folder = "results/quality_checks/deepdive"
+        jobs += [
+            (Render, coverage_day_figure, f"{folder}/{city}_sensor_percent_coverage_per_day.png", daily_coverage.loc[daily_coverage['city'] == city, ['year', 'parameter', 'station_name', 'sensor_percent_coverage_per_day', 'n_hours']], city),
+            (Render, coverage_year_figure, f"{folder}/{city}_sensors_percent_coverage_per_year.png", yearly_coverage.loc[yearly_coverage['city'] == city, ['year', 'parameter', 'station_name', 'sensors_percent_coverage_per_year', 'n_hours']], city),
+            (Render, active_sensors_figure, f"{folder}/{city}_active_sensors_per_day.png", city_day.loc[city_day['city'] == city, ['day', 'parameter', 'active_sensors_per_day_city_parameter']], city),
+            (Render, days_available_figure, f"{folder}/{city}_percent_days_avaiable_per_year.png", city_year.loc[city_year['city'] == city, ['year', 'parameter', 'percent_days_avaiable_per_city_year']], city)]
+    return jobs
+
+def weighted_describe(data, keys, column, weights):
+    # Same as data.groupby(keys)[column].describe() with each row repeated `weights` times, without repeating the rows
+    groups = data.groupby(keys, sort=True)
+    index = groups.size().index
+    codes = groups.ngroup().to_numpy()
+    values = data[column].to_numpy(dtype=float)
+    w = data[weights].to_numpy(dtype=float)
+    valid = (codes >= 0) & ~np.isnan(values)
+    order = np.lexsort((values[valid], codes[valid]))                              # By group, then by value
+    codes, values, w = codes[valid][order], values[valid][order], w[valid][order]
+
+    n = len(index)
+    count = np.bincount(codes, weights=w, minlength=n)
+    has = count > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, weights=w * values, minlength=n) / count
+        std = np.where(count > 1, np.sqrt(np.bincount(codes, weights=w * (values - mean[codes]) ** 2, minlength=n) / (count - 1)), np.nan)
+    cumulative = np.cumsum(w)
+    before = np.cumsum(count) - count                                              # Repeated rows of the previous groups
+
+    def nth(k):
+        # k-th smallest of the repeated values of each group
+        picked = np.searchsorted(cumulative, before + k, side='right')
+        return np.where(has, values[np.minimum(picked, max(len(values) - 1, 0))] if len(values) else np.nan, np.nan)
+
+    stats = {'count': count, 'mean': np.where(has, mean, np.nan), 'std': std, 'min': nth(0)}
+    for q in [0.25, 0.5, 0.75]:
+        position = q * np.maximum(count - 1, 0)
+        low = np.floor(position)
+        stats[f"{q:.0%}"] = nth(low) + (nth(np.minimum(low + 1, np.maximum(count - 1, 0))) - nth(low)) * (position - low)   # Linear interpolation, as pandas
+    stats['max'] = nth(np.maximum(count - 1, 0))
+    return pd.DataFrame(stats, index=index)
+
+def Deep_Dive_table(cities=config['quality_deep_locations'], load=Load_Clean):
+    # Deep dive tables of all the cities at once from the daily summaries (each day weighted by its hourly rows, as when computed on the hourly data)
     print("Making deep dive tables...")
+    only_cities = [('city', 'in', cities)]
+    sensor_day = load("sensor_day", columns=['city', 'parameter', 'station_name', 'sensor_id', 'day', 'year', 'n_hours', 'day_mean_value_per_station', 'mda8_per_station'], filters=only_cities)
+    sensor_year = load("sensor_year", columns=['city', 'parameter', 'station_name', 'sensor_id', 'year', 'sensors_percent_coverage_per_year'], filters=only_cities)
+    city_day = load("city_day", columns=['city', 'parameter', 'year', 'n_hours', 'day_mean_value', 'day_median_value', 'day_max_value'], filters=only_cities)
+    city_year = load("city_year", columns=['city', 'parameter', 'year', 'flag_city_parameter'], filters=only_cities)
+    sensor_day = sensor_day.merge(sensor_year, on=['city', 'parameter', 'station_name', 'sensor_id', 'year'], how='left')
+    station_keys = ['city', 'parameter', 'year', 'station_name', 'sensors_percent_coverage_per_year']
+    Path("results/quality_checks/deepdive").mkdir(parents=True, exist_ok=True)
 
     # AGGREGATION
-    for city in config['quality_deep_locations']:
-        data = clean_data[clean_data['city'] == city].copy()
-        
-        data['annual_mean'] = round(data.groupby(['year', 'city', 'parameter'])['day_mean_value'].transform('mean'), 2)
-        data['annual_mean_median'] = round(data.groupby(['year', 'parameter'])['day_median_value'].transform('mean'), 2)
-        data['annual_mean_max'] = round(data.groupby(['year', 'parameter'])['day_max_value'].transform('mean'), 2)
-        data['annual_mean_median_gap'] = round(data['annual_mean'] - data['annual_mean_median'], 2)
-        data['annual_mean_max_gap']    = round(data['annual_mean'] - data['annual_mean_max'], 2)
-        data['annual_max_median_gap']  = round(data['annual_mean_max'] - data['annual_mean_median'], 2)
-        data = data[['year', 'parameter', 'flag_city_parameter', 'annual_mean', 'annual_mean_median', 'annual_mean_max', 'annual_mean_median_gap', 'annual_mean_max_gap', 'annual_max_median_gap']].drop_duplicates()
-
-        data.to_csv(f"results/quality_checks/deepdive/{city}_aggregation.csv", index=False)
-
-    # STATIONS ANNUAL MEAN
-    for city in config['quality_deep_locations']:
-        data = clean_data[clean_data['city'] == city].copy()
-        desciptive = data.groupby(['parameter', 'year', 'station_name', 'sensors_percent_coverage_per_year'])['day_mean_value_per_station'].describe()
-        desciptive.to_csv(f"results/quality_checks/deepdive/{city}_annual_mean_per_station_descriptive.csv")
-    
-    # STATIONS EXCEEDANCE DAYS
-    for city in config['quality_deep_locations']:
-        data = clean_data[(clean_data['city'] == city) & (clean_data['parameter'] != "o3 µg/m³")].copy() # O3 excluded for absence of mda8 for station!
-        data['exceedance_per_station'] = data.apply(lambda x: calculate_compliance_eu_2030_days(x, aggregation="station"), axis=1)
-        data = data.drop_duplicates(subset=['day', 'parameter', 'station_name', 'exceedance_per_station'])
-        data['exceedance_days_per_station'] = data.groupby(['year', 'parameter', 'station_name'])['exceedance_per_station'].transform('sum')
-        desciptive = data.groupby(['parameter', 'year', 'station_name', 'sensors_percent_coverage_per_year'])[['exceedance_days_per_station']].first()
-        desciptive = pd.DataFrame(desciptive)
-        desciptive.to_csv(f"results/quality_checks/deepdive/{city}_exceedance_days_per_station_descriptive.csv")
+    means = {}
+    for column, name in [('day_mean_value', 'annual_mean'), ('day_median_value', 'annual_mean_median'), ('day_max_value', 'annual_mean_max')]:
+        weights = city_day['n_hours'].where(city_day[column].notna(), 0)
+        sums = pd.DataFrame({'weighted': city_day[column].fillna(0) * weights, 'weights': weights}).groupby([city_day['city'], city_day['parameter'], city_day['year']]).sum()
+        means[name] = round(sums['weighted'] / sums['weights'], 2)
+    aggregation = city_year.set_index(['city', 'parameter', 'year']).join(pd.DataFrame(means), how='inner').reset_index()
+    aggregation['annual_mean_median_gap'] = round(aggregation['annual_mean'] - aggregation['annual_mean_median'], 2)
+    aggregation['annual_mean_max_gap']    = round(aggregation['annual_mean'] - aggregation['annual_mean_max'], 2)
+    aggregation['annual_max_median_gap']  = round(aggregation['annual_mean_max'] - aggregation['annual_mean_median'], 2)
+    aggregation = aggregation.sort_values(['city', 'parameter', 'year'], ignore_index=True)
+
+    # STATIONS ANNUAL MEAN (each sensor-day weighted by its hourly rows)
+    annual_mean = weighted_describe(sensor_day, station_keys, 'day_mean_value_per_station', 'n_hours')
+
+    # STATIONS EXCEEDANCE DAYS (one row for each station-day, with the yearly coverage of its first sensor)
+    days = sensor_day.sort_values(['city', 'parameter', 'station_name', 'day', 'sensor_id']).drop_duplicates(['city', 'parameter', 'station_name', 'day'])
+    days = days.assign(exceedance_per_station=calculate_compliance_eu_2030_days(days, 'day_mean_value_per_station', 'mda8_per_station'))
+    days['exceedance_days_per_station'] = days.groupby(['city', 'parameter', 'year', 'station_name'])['exceedance_per_station'].transform('sum').astype(int)   # Days without a valid value are not counted
+    exceedance = days.groupby(station_keys)[['exceedance_days_per_station']].first()
+
+    for city in cities:
+        aggregation.loc[aggregation['city'] == city, ['year', 'parameter', 'flag_city_parameter', 'annual_mean', 'annual_mean_median', 'annual_mean_max', 'annual_mean_median_gap', 'annual_mean_max_gap', 'annual_max_median_gap']].to_csv(f"results/quality_checks/deepdive/{city}_aggregation.csv", index=False)
+        annual_mean[annual_mean.index.get_level_values('city') == city].droplevel('city').reorder_levels(['parameter', 'year', 'station_name', 'sensors_percent_coverage_per_year']).to_csv(f"results/quality_checks/deepdive/{city}_annual_mean_per_station_descriptive.csv")
+        exceedance[exceedance.index.get_level_values('city') == city].droplevel('city').reorder_levels(['parameter', 'year', 'station_name', 'sensors_percent_coverage_per_year']).to_csv(f"results/quality_checks/deepdive/{city}_exceedance_days_per_station_descriptive.csv")
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import yaml
+from pathlib import Path
+
+with open("config.yml", "r", encoding="utf-8") as f:
+    config = yaml.safe_load(f)
+
+STANDARD_COLUMNS = ['set', 'parameter', 'period', 'metric', 'limit', 'allowed', 'years']
+EXCEEDANCE_PERIODS = ['daily', '8h']                                               # Assessed on the days above the limit, 'annual' on the yearly mean
+
+def Standards():
+    # Declared standards as a table (no exceedances allowed and a single year unless stated)
+    standards = pd.DataFrame(config['standards'], columns=STANDARD_COLUMNS)
+    return standards.assign(set=standards['set'].astype(str), allowed=standards['allowed'].fillna(0).astype(int), years=standards['years'].fillna(1).astype(int))
+
+def Standard_Limits(standard_set, periods):
+    # {parameter: limit} of one set of standards, e.g. Standard_Limits('2030', ['annual'])
+    standards = Standards()
+    chosen = standards[(standards['set'] == standard_set) & standards['period'].isin(periods)]
+    return dict(zip(chosen['parameter'], chosen['limit']))
+
+def exceedance_days(codes, values, query_codes, limits):
+    # Days above each limit within its group: one sort of the daily values, then two binary searches per (group, limit)
+    values = np.where(np.isnan(values), -np.inf, values)                           # Missing days never exceed
+    ordered = np.sort(values)
+    step = len(values) + 1
+    keys = np.sort(codes * step + np.searchsorted(ordered, values, side='left'))   # Group, then days strictly below the value
+    threshold = np.searchsorted(ordered, limits, side='right')                    # Exceeding means more days below than at or below the limit
+    return np.searchsorted(keys, (query_codes + 1) * step) - np.searchsorted(keys, query_codes * step + threshold)
+
+def Evaluate_Standards(daily_data):
+    print("Evaluating standards...")
+    keys = ['parameter', 'city', 'year']
+    groups = daily_data.groupby(keys, sort=True)
+    codes = groups.ngroup().to_numpy()
+    evaluation = (groups.size().reset_index()[keys].rename_axis('group').reset_index()
+                  .merge(Standards().rename_axis('standard').reset_index(), on='parameter'))   # Every standard of the parameter for each city-year
+    evaluation = evaluation.sort_values(['standard', 'city', 'year'], ignore_index=True)
+
+    value = np.full(len(evaluation), np.nan)
+    annual = (evaluation['period'] == 'annual').to_numpy()
+    for metric in evaluation['metric'].unique():
+        rows = (evaluation['metric'] == metric).to_numpy()
+        means = groups[metric].mean().to_numpy()
+        value[rows & annual] = means[evaluation['group'].to_numpy()[rows & annual]]
+        exceedance = rows & ~annual
+        value[exceedance] = exceedance_days(codes, daily_data[metric].to_numpy(dtype=float), evaluation['group'].to_numpy()[exceedance], evaluation['limit'].to_numpy(dtype=float)[exceedance])
+
+    # Exceedance days averaged over the year and the previous ones, when all of them are available
+    years = evaluation['years'].to_numpy()
+    days = pd.Series(value, index=pd.MultiIndex.from_arrays([evaluation['standard'], evaluation['city'], evaluation['year']]))
+    total = value.copy()
+    for lag in range(1, years.max()):
+        previous = days.reindex(pd.MultiIndex.from_arrays([evaluation['standard'], evaluation['city'], evaluation['year'] - lag])).to_numpy()
+        total = np.where(lag < years, total + previous, total)
+    total[(years > 1) & (evaluation['year'].to_numpy() < config['yearfrom'] + years - 1)] = np.nan   # Windows starting before the analysed period
+    evaluation['value'] = np.where(annual, value, total / years)
+
+    within = np.where(annual, evaluation['value'] <= evaluation['limit'], evaluation['value'] <= evaluation['allowed'])
+    evaluation['compliant'] = pd.array(within, dtype="boolean")
+    evaluation.loc[evaluation['value'].isna(), 'compliant'] = pd.NA
+    evaluation = evaluation[['set', 'parameter', 'period', 'metric', 'limit', 'allowed', 'years', 'city', 'year', 'value', 'compliant']]
+    Path("results").mkdir(parents=True, exist_ok=True)
+    evaluation.to_csv("results/standards_compliance.csv", index=False)
+    return evaluation
+
+def Load_Standards_Evaluation():
+    return pd.read_csv("results/standards_compliance.csv", dtype={'set': str, 'compliant': "boolean"})
@@ -0,0 +1,30 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture(scope="session")
+def write_raw():
+    # Folder with the repo config and synthetic hourly raw data (two stations for each city, one sensor for each station and parameter)
+    def write(root, cities, start, end):
+        (root / "data/raw").mkdir(parents=True)
+        shutil.copy(REPO / "config.yml", root)
+        rng = np.random.default_rng(0)
+        utc = pd.date_range(start, end, freq="h", tz="UTC")
+        stations = [(city, f"{city} St{i}", 45.0 + n / 2 + i / 10) for n, city in enumerate(cities) for i in range(2)]
+        raw = [pd.DataFrame({'value': rng.gamma(4, 10, len(utc)).round(1), 'parameter': parameter, 'city': city, 'station_name': station,
+                             'sensor_id': 10 * i + j, 'period.datetime_from.utc': utc.strftime("%Y-%m-%dT%H:%M:%SZ")})
+               for i, (city, station, _) in enumerate(stations) for j, parameter in enumerate(["no2 µg/m³", "o3 µg/m³"])]
+        pd.concat(raw).to_csv(root / "data/raw/raw_data.csv", index=False)
+        pd.DataFrame({'id': range(len(stations)), 'name': [s for _, s, _ in stations], 'locality': [c for c, _, _ in stations], 'timezone': "Europe/Rome",
+                      'country.id': 1, 'country.code': "IT", 'country.name': "Italy", 'owner.id': 1, 'owner.name': "o", 'provider.id': 1, 'provider.name': "p",
+                      'isMobile': False, 'isMonitor': True, 'instruments': "[]", 'sensors': "[]", 'coordinates.latitude': [lat for _, _, lat in stations],
+                      'coordinates.longitude': 7.5, 'bounds': "[]", 'datetime_first.utc': "x", 'datetime_first.local': "x", 'datetime_last.utc': "y",
+                      'datetime_last.local': "y"}).to_csv(root / "data/raw/sensors.csv", index=False)
+        return root
+    return write
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from project.aggregates import Day_States, Merge_States, Finalize_States, sketch_median
+from project.processing import Save_Clean, Load_Clean
+
+KEYS = ['city', 'parameter', 'station_name', 'sensor_id', 'day', 'year']
+
+
+def hourly_values(seed=0):
+    # 2 stations, 3 sensors, 2 days of hourly values with gaps
+    rng = np.random.default_rng(seed)
+    rows = pd.DataFrame([(station, sensor, day, hour) for station, sensor in [("A", 1), ("A", 2), ("B", 3)]
+                         for day in pd.to_datetime(["2023-06-01", "2023-06-02"]).date for hour in range(24)],
+                        columns=['station_name', 'sensor_id', 'day', 'hour'])
+    rows = rows.assign(city="Torino", parameter="no2 µg/m³", year=2023, value=rng.normal(30, 10, len(rows)).round(1)).sample(frac=0.8, random_state=seed)
+    return rows.reset_index(drop=True)
+
+
+def comparable(states):
+    # Sketch arrays as tuples, so that the states can be compared as frames
+    states = states.sort_values(KEYS, ignore_index=True)
+    return states.assign(sketch_values=states['sketch_values'].map(tuple), sketch_weights=states['sketch_weights'].map(tuple))
+
+
+def test_merges_are_associative_and_order_independent():
+    rows = hourly_values()
+    chunk = np.random.default_rng(1).integers(0, 3, len(rows))                       # Rows split across 3 chunks (workers, runs...)
+    a, b, c = [Day_States(rows[chunk == i], KEYS, rows.loc[chunk == i, 'hour'].to_numpy()) for i in range(3)]
+
+    left = Merge_States([Merge_States([a, b], KEYS), c], KEYS)
+    right = Merge_States([a, Merge_States([b, c], KEYS)], KEYS)
+    shuffled = Merge_States(pd.concat([c, a, b]).sample(frac=1, random_state=2), KEYS)
+    direct = Day_States(rows, KEYS, rows['hour'].to_numpy())
+
+    for merged in [left, right, shuffled]:
+        pd.testing.assert_frame_equal(comparable(merged), comparable(direct), check_dtype=False)
+
+
+def test_states_survive_a_parquet_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows = hourly_values()
+    states = Day_States(rows, KEYS, rows['hour'].to_numpy())
+
+    Save_Clean({"sensor_day_state": states})
+    loaded = Load_Clean("sensor_day_state")[states.columns]
+
+    pd.testing.assert_frame_equal(comparable(loaded), comparable(states), check_dtype=False)
+    station_keys = ['city', 'parameter', 'station_name', 'day']
+    pd.testing.assert_frame_equal(Finalize_States(Merge_States(loaded, station_keys)), Finalize_States(Merge_States(states, station_keys)))
+
+
+def test_sketch_median_is_exact_up_to_the_sketch_size():
+    # Groups of 1 to 64 values, also after merging two partial states of the same group
+    rng = np.random.default_rng(3)
+    sizes = np.arange(1, 65)
+    rows = pd.DataFrame({'group': np.repeat(sizes, sizes), 'value': rng.normal(30, 10, sizes.sum()).round(1)})
+    rows['part'] = rng.integers(0, 2, len(rows))
+    hours = np.zeros(len(rows), dtype=int)
+    expected = rows.groupby('group')['value'].median().to_numpy()
+
+    states = Day_States(rows, ['group'], hours)
+    parts = Merge_States([Day_States(rows[rows['part'] == i], ['group'], hours[rows['part'] == i]) for i in range(2)], ['group'])
+
+    np.testing.assert_array_equal(sketch_median(states), expected)
+    np.testing.assert_array_equal(sketch_median(parts), expected)
@@ -0,0 +1,35 @@
+from pathlib import Path
+
+import pytest
+
+testing = pytest.importorskip("streamlit.testing.v1")
+
+REPO = Path(__file__).resolve().parents[1]
+PAGES = ["overview", "compliance", "time_series", "city_comparison", "station_deepdive", "quality_checks", "methodology"]
+
+
+@pytest.fixture(scope="module")
+def dashboard(tmp_path_factory, write_raw):
+    # Two years of hourly data for two cities, cleaned by the pipeline into a fresh processed store
+    root = write_raw(tmp_path_factory.mktemp("dashboard"), ["Torino", "Milano"], "2023-01-01", "2024-12-31 23:00")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("API_KEY", "x")
+        from project.pipeline import clean_data
+        mp.chdir(root)
+        clean_data(workers=1)
+        yield root
+
+
+def test_every_page_runs_on_the_processed_tables(dashboard, monkeypatch):
+    monkeypatch.chdir(dashboard)
+    app = testing.AppTest.from_file(str(REPO / "streamlit_app.py"), default_timeout=60).run()
+    for page in PAGES:
+        app.switch_page(f"pages/{page}.py").run()
+        assert not app.exception, page
+        for selectbox in [s for s in app.selectbox if s.label == "Select Pollutant"]:   # Both the mean and the MDA8 branches of the time series
+            for pollutant in selectbox.options:
+                selectbox.set_value(pollutant).run()
+                assert not app.exception, (page, pollutant)
+        for multiselect in app.multiselect:
+            multiselect.set_value(multiselect.options).run()
+            assert not app.exception, page
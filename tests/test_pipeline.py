@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+TABLES = ['station_descriptive', 'sensor_year', 'sensor_coverage', 'sensor_day', 'sensor_day_state', 'city_day', 'city_year']
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setenv("API_KEY", "x")
+    import project.pipeline
+    return project.pipeline
+
+
+def stored_files():
+    return {path: (path.read_bytes(), path.stat().st_mtime_ns) for path in Path("data/processed").rglob("*.parquet")}
+
+
+def test_incremental_run_recomputes_only_the_edited_partition(tmp_path, monkeypatch, write_raw, pipeline):
+    from project.processing import Clean, Dirty_Partitions, Fingerprint_Partitions, Load_Clean
+    root = write_raw(tmp_path / "incremental", ["Torino"], "2022-01-01", "2024-12-31 23:00")
+    monkeypatch.chdir(root)
+    pipeline.clean_tables(incremental=True, chunked=False, workers=1)
+    before = stored_files()
+
+    # Editing one day of no2 in 2023
+    raw = pd.read_csv("data/raw/raw_data.csv")
+    edited = (raw['parameter'] == "no2 µg/m³") & raw['period.datetime_from.utc'].str.startswith("2023-05-10")
+    raw.loc[edited, 'value'] += 15
+    raw.to_csv("data/raw/raw_data.csv", index=False)
+
+    dirty = Dirty_Partitions(Fingerprint_Partitions(Clean()[0]))
+    assert dirty == {("Torino", "no2 µg/m³", 2023), ("Torino", "no2 µg/m³", 2024)}   # The edited year and the next one (context of its first rolling means)
+
+    pipeline.clean_tables(incremental=True, chunked=False, workers=1)
+    after = stored_files()
+
+    recomputed = [path for path in before if "parameter=no2" in str(path) and any(f"year={year}" in str(path) for year in [2023, 2024])]
+    assert recomputed and set(after) == set(before)
+    for path, (content, mtime) in before.items():
+        if path not in recomputed:
+            assert after[path] == (content, mtime), path                         # Untouched partitions are not rewritten
+
+    # Same tables as a full run on the edited raw data
+    full = tmp_path / "full"
+    (full / "data/raw").mkdir(parents=True)
+    for name in ["config.yml", "data/raw/raw_data.csv", "data/raw/sensors.csv"]:
+        (full / name).write_bytes((root / name).read_bytes())
+    monkeypatch.chdir(full)
+    pipeline.clean_tables(incremental=False, chunked=False, workers=1)
+    for table in TABLES:
+        expected = Load_Clean(table)
+        monkeypatch.chdir(root)
+        result = Load_Clean(table)[expected.columns]
+        monkeypatch.chdir(full)
+        keys = [c for c in ['city', 'parameter', 'year', 'station_name', 'sensor_id', 'day'] if c in expected.columns]
+        pd.testing.assert_frame_equal(result.sort_values(keys, ignore_index=True).astype(str), expected.sort_values(keys, ignore_index=True).astype(str), obj=table)
@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+from project.aggregates import Day_States
+from project.processing import Calculate_Average_Values, Coverage_Hours, Coverage_Index, Daily_Tables, Flatline, Local_Datetime, Local_Hours, Longest_Gap, Save_Tensor, Load_Tensor, Time_Aggregation, group_median, roll_and_mda8
+
+
+def baseline_roll_and_mda8(g, tz_local):
+    # add_roll_and_mda8 of the original per-series loop, as reference
+    g = g.sort_values("utc_datetime")
+    s = g.drop_duplicates("utc_datetime").set_index("utc_datetime")["median_hourly_value"].asfreq("h")
+    r8 = s.rolling(8, min_periods=6).mean()
+    day_local = r8.index.tz_convert(tz_local).floor("D")
+    mda8 = r8.groupby(day_local).max()
+    total = pd.Series(1, index=r8.index).groupby(day_local).sum()
+    valid = r8.notna().groupby(day_local).sum()
+    mda8_valid = mda8.where(valid >= np.ceil(total * 0.75).astype(int))
+    return (pd.DataFrame({"utc_datetime": r8.index, "rolling_8h_mean": r8.values}),
+            pd.DataFrame({"day": mda8_valid.index.date, "mda8": mda8_valid.values}))
+
+
+def test_station_median_exact_above_sketch_size():
+    # 3 sensors x 25 hours (75 values, day with the DST change) in one station-day, more than the 64 items of a sketch
+    rng = np.random.default_rng(0)
+    hours = np.tile(np.arange(25), 3)
+    clean_data = pd.DataFrame({
+        'city': "Torino", 'parameter': "no2 µg/m³", 'station_name': "Station", 'sensor_id': np.repeat([1, 2, 3], 25),
+        'day': pd.Timestamp("2023-10-29").date(), 'year': 2023, 'day_of_the_week': "Sunday", 'season': "Autumn",
+        'value': rng.normal(25, 8, len(hours)).round(1), 'active_sensors_per_day_city_parameter': 3,
+        'year_median_active_sensors_per_city_parameter': 3, 'percent_days_avaiable_per_city_year': 100})
+    states = Day_States(clean_data, ['city', 'parameter', 'station_name', 'sensor_id', 'day', 'year'], hours)
+    nan = np.full(len(clean_data), np.nan)
+
+    sensor_day, city_day, _ = Daily_Tables(clean_data, nan, nan, states)
+
+    assert (sensor_day['day_median_value_per_station'] == clean_data['value'].median()).all()
+    assert city_day['day_median_value'].iloc[0] == clean_data['value'].median()
+
+
+def test_flatline_counts_duplicated_rows_once():
+    # 3 distinct hours with the same value, each row fetched twice, then a 4th hour for the other sensor
+    times = pd.to_datetime(["2023-01-01 00:00", "2023-01-01 01:00", "2023-01-01 02:00"], utc=True)
+    raw_data = pd.DataFrame({'sensor_id': [1] * 6 + [2] * 4, 'value': 10.0,
+                             'utc_datetime': list(times.repeat(2)) + list(pd.date_range("2023-01-01", periods=4, freq="h", tz="UTC"))})
+
+    flat = Flatline(raw_data, 'value', 4)
+
+    assert not flat[raw_data['sensor_id'] == 1].any()
+    assert flat[raw_data['sensor_id'] == 2].all()
+
+
+def test_tensor_rows_of_a_sensor_under_two_stations(tmp_path, monkeypatch):
+    # Sensor 7 listed under two station names: one tensor row for each (station, sensor)
+    monkeypatch.chdir(tmp_path)
+    hours = pd.date_range("2023-06-01", periods=3, freq="h", tz="UTC")
+    clean = pd.DataFrame({'city': "Torino", 'parameter': "no2 µg/m³", 'station_name': ["A"] * 3 + ["B"] * 3, 'sensor_id': 7,
+                          'utc_datetime': list(hours) * 2, 'value': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+    tables = {"sensor_day": clean[['city', 'parameter', 'station_name', 'sensor_id']], "clean": clean}
+
+    def load(name, columns=None, filters=None):
+        return tables[name][columns].reset_index(drop=True)
+
+    Save_Tensor(load)
+    values, sensors, axis = Load_Tensor()
+
+    start = axis.get_loc(hours[0])
+    assert list(sensors['station_name']) == ["A", "B"]
+    np.testing.assert_array_equal(values[:, start:start + 3], [[1, 2, 3], [4, 5, 6]])
+
+
+def test_mda8_window_stops_at_the_last_measured_hour():
+    # Series from 2023-06-10 01:00 to 2023-06-14 10:00 UTC on a grid widened by a longer series:
+    # the first and last days are judged on the measured hours only, as in the per-series loop
+    utc = pd.date_range("2023-06-10 01:00", "2023-06-14 10:00", freq="h", tz="UTC")
+    values = 60 + 20 * np.sin(np.arange(len(utc)) / 4)
+    series = pd.DataFrame({'utc_datetime': utc, 'median_hourly_value': values})
+    _, expected = baseline_roll_and_mda8(series, "Europe/Rome")
+
+    other = pd.date_range("2023-06-09 00:00", "2023-06-15 23:00", freq="h", tz="UTC")
+    t0 = other[0]
+    codes = np.r_[np.zeros(len(utc), dtype=int), np.ones(len(other), dtype=int)]
+    pos = np.r_[(utc - t0) // pd.Timedelta(hours=1), np.arange(len(other))]
+    _, mda8 = roll_and_mda8(codes, pos, np.r_[values, np.full(len(other), 50.0)], ["Europe/Rome", "Europe/Rome"], t0)
+
+    result = pd.Series(mda8[:len(utc)]).groupby(utc.tz_convert("Europe/Rome").date).first()
+    assert result.notna().all()
+    np.testing.assert_allclose(result.to_numpy(), expected.set_index('day')['mda8'].reindex(result.index).to_numpy())
+
+
+def hourly_rows(seed=0):
+    # Two cities in different timezones, each around a DST change, starting and ending mid-day, with gaps
+    rng = np.random.default_rng(seed)
+    frames = []
+    for city, tz, start, end in [("Torino", "Europe/Rome", "2023-03-24 13:00", "2023-03-28 09:00"),
+                                 ("Lisboa", "Europe/Lisbon", "2023-10-27 15:00", "2023-10-31 06:00")]:
+        utc = pd.date_range(start, end, freq="h", tz="UTC")
+        for parameter in ["o3 µg/m³", "no2 µg/m³"]:
+            for station, sensor in [("A", 1), ("A", 2), ("B", 3)]:
+                frames.append(pd.DataFrame({'city': city, 'timezone': tz, 'parameter': parameter, 'station_name': station,
+                                            'sensor_id': sensor, 'utc_datetime': utc, 'value': rng.gamma(4, 10, len(utc)).round(1)}))
+    clean_data = pd.concat(frames, ignore_index=True)
+    clean_data = clean_data.sample(frac=0.85, random_state=seed).sort_values(['city', 'parameter', 'sensor_id', 'utc_datetime'])   # Gaps
+    clean_data = clean_data[~((clean_data['city'] == "Torino") & clean_data['utc_datetime'].between("2023-03-26 04:00", "2023-03-26 09:00"))]   # Long gap
+    clean_data = clean_data.reset_index(drop=True)
+
+    clean_data['timezone'] = clean_data['timezone'].astype('category')
+    clean_data['local_datetime'] = Local_Datetime(clean_data['utc_datetime'], clean_data['timezone'])
+    clean_data = Time_Aggregation(clean_data)
+    clean_data['local_hour'], _ = Local_Hours(clean_data)
+    clean_data['active_sensors_per_day_city_parameter'] = 3
+    clean_data['year_median_active_sensors_per_city_parameter'] = 3
+    clean_data['percent_days_avaiable_per_city_year'] = 100.0
+    return clean_data
+
+
+def test_vectorized_daily_values_match_the_groupby_path():
+    clean_data = hourly_rows()
+
+    # Original path: transforms over the hourly rows and one add_roll_and_mda8 call per (city, parameter)
+    expected = clean_data.copy()
+    station = expected.groupby(['day', 'city', 'parameter', 'station_name'])['value']
+    expected['day_mean_value_per_station'] = station.transform('mean')
+    expected['day_max_value_per_station'] = station.transform('max')
+    expected['day_median_value_per_station'] = station.transform('median')
+    city = expected.groupby(['day', 'city', 'parameter'])
+    expected['day_mean_value'] = city['day_mean_value_per_station'].transform('mean')
+    expected['day_max_value'] = city['day_max_value_per_station'].transform('max')
+    expected['day_median_value'] = city['day_median_value_per_station'].transform('median')
+    expected['median_hourly_value'] = expected.groupby(['city', 'parameter', 'utc_datetime'])['value'].transform('median')
+    hourly_tbl, daily_tbl = [], []
+    for (city, parameter), g in expected.groupby(['city', 'parameter'], observed=True):
+        h, d = baseline_roll_and_mda8(g, g['timezone'].iloc[0])
+        h['city'], h['parameter'] = city, parameter
+        d['city'], d['parameter'] = city, parameter
+        hourly_tbl.append(h)
+        daily_tbl.append(d)
+    expected = expected.merge(pd.concat(hourly_tbl), on=['city', 'parameter', 'utc_datetime'], how='left')
+    expected = expected.merge(pd.concat(daily_tbl), on=['city', 'parameter', 'day'], how='left')
+
+    tables = Calculate_Average_Values(clean_data.copy())
+
+    keys = ['city', 'parameter', 'day']
+    columns = ['day_mean_value', 'day_max_value', 'day_median_value', 'mda8']
+    city_day = tables['city_day'].set_index(keys)[columns].sort_index()
+    pd.testing.assert_frame_equal(city_day, expected.drop_duplicates(keys).set_index(keys)[columns].sort_index(), check_dtype=False)
+    assert city_day['mda8'].notna().any() and city_day['mda8'].isna().any()
+
+    hourly_keys = ['city', 'parameter', 'sensor_id', 'utc_datetime']
+    hourly = tables['clean'].set_index(hourly_keys)[['median_hourly_value', 'rolling_8h_mean']].sort_index()
+    pd.testing.assert_frame_equal(hourly, expected.set_index(hourly_keys)[['median_hourly_value', 'rolling_8h_mean']].sort_index(), check_dtype=False)
+
+
+def test_group_median_matches_groupby_median():
+    # Groups of odd and even sizes, single values, all NaN, some NaN, and empty groups (codes never used)
+    rng = np.random.default_rng(1)
+    codes = np.r_[np.repeat([0, 1, 2, 3, 4, 6], [7, 8, 1, 3, 6, 25]), rng.integers(8, 40, 300)]
+    values = rng.normal(30, 10, len(codes)).round(1)
+    values[codes == 3] = np.nan
+    values[np.flatnonzero(codes == 4)[:3]] = np.nan                                  # Even size, odd count of values
+    values[rng.choice(np.flatnonzero(codes >= 8), 40, replace=False)] = np.nan
+    order = rng.permutation(len(codes))
+    codes, values = codes[order], values[order]
+
+    expected = pd.Series(values).groupby(codes).median().reindex(range(41))
+
+    np.testing.assert_array_equal(group_median(codes, values, 41), expected.to_numpy())
+
+
+def test_coverage_of_dst_days():
+    # Day of 23 hours missing its last 4 hours, day of 25 hours missing the first 02:00 and its last 3 hours, day of 24 hours missing its first 5
+    days = [("2023-03-26", 23, [19, 20, 21, 22]), ("2023-10-29", 25, [2, 22, 23, 24]), ("2023-06-01", 24, [0, 1, 2, 3, 4])]
+    utc = []
+    for day, length, missing in days:
+        midnight = pd.Timestamp(day, tz="Europe/Rome").tz_convert("UTC")
+        utc += [midnight + pd.Timedelta(hours=h) for h in range(length) if h not in missing]
+    clean_data = pd.DataFrame({'city': "Torino", 'parameter': "no2 µg/m³", 'station_name': "A", 'sensor_id': 1, 'value': 1.0,
+                               'utc_datetime': pd.DatetimeIndex(utc), 'timezone': pd.Categorical(["Europe/Rome"] * len(utc))})
+    clean_data['local_datetime'] = Local_Datetime(clean_data['utc_datetime'], clean_data['timezone'])
+    clean_data['day'] = clean_data['local_datetime'].dt.date
+    clean_data['year'] = clean_data['local_datetime'].dt.year
+
+    coverage, _ = Coverage_Index(clean_data)
+    coverage['measured_hours'] = Coverage_Hours(coverage['hours_mask'].to_numpy())
+    coverage['longest_gap_hours'] = Longest_Gap(coverage['hours_mask'].to_numpy(), coverage['day_length'].to_numpy())
+    coverage = coverage.set_index(coverage['day'].astype(str)).loc[[day for day, _, _ in days]]
+
+    assert list(coverage['day_length']) == [23, 25, 24]
+    assert list(coverage['measured_hours']) == [19, 21, 19]
+    assert list(coverage['longest_gap_hours']) == [4, 3, 5]                        # The gaps at the end of the short and long days end on their last hour
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from project.results import CAQI_Table, weighted_describe
+
+
+def test_weighted_describe_matches_repeated_rows():
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'station': rng.choice(["A", "B", "C"], 200), 'value': rng.normal(30, 10, 200).round(1), 'n_hours': rng.integers(1, 25, 200)})
+    data.loc[data.sample(20, random_state=0).index, 'value'] = np.nan
+    data = pd.concat([data, pd.DataFrame({'station': ["D", "E"], 'value': [12.5, np.nan], 'n_hours': [3, 5]})], ignore_index=True)   # One value, no value
+
+    expected = data.loc[data.index.repeat(data['n_hours'])].groupby('station')['value'].describe()
+
+    pd.testing.assert_frame_equal(weighted_describe(data, ['station'], 'value', 'n_hours'), expected)
+
+
+def categories(column):
+    return [None if pd.isna(v) else v for v in column]
+
+
+def test_caqi_classes_follow_the_breakpoint_grid(tmp_path, monkeypatch):
+    # pm25 classified on the daily mean, no2 on the daily max (bands 0-10-20-25-50-75 and 0-40-90-120-230-340 µg/m³, upper bound included)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data/processed").mkdir(parents=True)
+    pm25 = [0, 10, 10.1, 20, 25, 49.9, 50, 75, 75.1, 900, -0.5, np.nan]
+    no2 = [40, 40.1, 0, 120, 230, 230.1, 340, 340.1, np.nan, 35, 10, 500]
+    days = pd.date_range("2023-01-01", periods=len(pm25)).date
+    daily_data = pd.DataFrame({'city': "Torino", 'year': 2023, 'day': np.tile(days, 2), 'parameter': ["pm25 µg/m³"] * len(pm25) + ["no2 µg/m³"] * len(no2),
+                               'day_mean_value': pm25 + [1.0] * len(no2), 'day_max_value': [1000.0] * len(pm25) + no2})
+
+    caqi = CAQI_Table(daily_data)
+
+    expected_pm25 = [1, 1, 2, 2, 3, 4, 4, 5, 6, 6, None, None]
+    expected_no2 = [1, 2, 1, 3, 4, 5, 5, 6, None, 1, 1, 6]
+    assert categories(caqi['CAQI']) == expected_pm25 + expected_no2
+    assert categories(caqi['CAQI_qual'])[:3] == ['Good', 'Good', 'Fair']
+    assert caqi['CAQI_qual'].isna().tolist() == caqi['CAQI'].isna().tolist()
+    expected_global = [max(filter(None, pair), default=None) for pair in zip(expected_pm25, expected_no2)]
+    assert categories(caqi['CAQI_global']) == expected_global * 2   # Worst parameter of each day
+    pd.testing.assert_frame_equal(pd.read_parquet("data/processed/caqi_daily.parquet"), caqi)
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from project.standards import Evaluate_Standards, exceedance_days
+
+nan = np.nan
+
+
+def test_exceedance_days_count_days_strictly_above_the_limit():
+    codes = np.array([0, 0, 0, 0, 2, 2])
+    values = np.array([50, 50.5, 49, nan, 10, 80])
+
+    assert list(exceedance_days(codes, values, np.array([0, 0, 0, 1, 2, 2]), np.array([50, 49, 100, 0, 10, -5]))) == [1, 2, 0, 0, 1, 2]
+
+
+def test_every_standard_set_against_a_hand_computed_table(tmp_path, monkeypatch):
+    # One year of pm25, pm10 and no2 (2021, first analysed year), o3 in 2021 and 2023-2025 (2022 missing)
+    monkeypatch.chdir(tmp_path)
+    days = {("pm25 µg/m³", 2021): [5, 15, 25, 40], ("pm10 µg/m³", 2021): [45, 50, 50.5, nan], ("no2 µg/m³", 2021): [10, 20, 30],
+            ("o3 µg/m³", 2021): [130, 120, 100.5], ("o3 µg/m³", 2023): [121, 90], ("o3 µg/m³", 2024): [150, 140, 130, 125], ("o3 µg/m³", 2025): [119, 200]}
+    daily_data = pd.DataFrame([(parameter, year, value) for (parameter, year), values in days.items() for value in values], columns=['parameter', 'year', 'value'])
+    daily_data = daily_data.assign(city="Torino",
+                                   day_mean_value=daily_data['value'].where(daily_data['parameter'] != "o3 µg/m³"),
+                                   mda8=daily_data['value'].where(daily_data['parameter'] == "o3 µg/m³"))
+
+    evaluation = Evaluate_Standards(daily_data)
+
+    expected = pd.DataFrame([
+        # set, parameter, period, year, value, compliant
+        ('current', 'pm25 µg/m³', 'annual', 2021, 21.25, True),
+        ('current', 'pm10 µg/m³', 'annual', 2021, 48.5, False),
+        ('current', 'pm10 µg/m³', 'daily', 2021, 1, True),                        # 50 is at the limit, not above it
+        ('current', 'no2 µg/m³', 'annual', 2021, 20, True),
+        ('current', 'o3 µg/m³', '8h', 2021, nan, None),                           # 3-year window starting before 2021
+        ('current', 'o3 µg/m³', '8h', 2023, nan, None),                           # Windows with 2022 missing
+        ('current', 'o3 µg/m³', '8h', 2024, nan, None),
+        ('current', 'o3 µg/m³', '8h', 2025, 2, True),                             # (1 + 4 + 1) / 3 days above 120
+        ('2030', 'pm25 µg/m³', 'annual', 2021, 21.25, False),
+        ('2030', 'pm25 µg/m³', 'daily', 2021, 1, True),
+        ('2030', 'pm10 µg/m³', 'annual', 2021, 48.5, False),
+        ('2030', 'pm10 µg/m³', 'daily', 2021, 2, True),
+        ('2030', 'no2 µg/m³', 'annual', 2021, 20, True),                          # At the limit
+        ('2030', 'no2 µg/m³', 'daily', 2021, 0, True),
+        ('2030', 'o3 µg/m³', '8h', 2021, nan, None),
+        ('2030', 'o3 µg/m³', '8h', 2023, nan, None),
+        ('2030', 'o3 µg/m³', '8h', 2024, nan, None),
+        ('2030', 'o3 µg/m³', '8h', 2025, 2, True),
+        ('who', 'pm25 µg/m³', 'annual', 2021, 21.25, False),
+        ('who', 'pm25 µg/m³', 'daily', 2021, 2, True),                            # 15 is at the limit
+        ('who', 'pm10 µg/m³', 'annual', 2021, 48.5, False),
+        ('who', 'pm10 µg/m³', 'daily', 2021, 2, True),
+        ('who', 'no2 µg/m³', 'annual', 2021, 20, False),
+        ('who', 'no2 µg/m³', 'daily', 2021, 1, True),
+        ('who', 'o3 µg/m³', '8h', 2021, 3, True),                                 # Single year window
+        ('who', 'o3 µg/m³', '8h', 2023, 1, True),
+        ('who', 'o3 µg/m³', '8h', 2024, 4, False),
+        ('who', 'o3 µg/m³', '8h', 2025, 2, True),
+    ], columns=['set', 'parameter', 'period', 'year', 'value', 'compliant'])
+    expected['compliant'] = expected['compliant'].astype("boolean")
+
+    keys = ['set', 'parameter', 'period', 'year']
+    result = evaluation[keys + ['value', 'compliant']].sort_values(keys, ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected.sort_values(keys, ignore_index=True), check_dtype=False)